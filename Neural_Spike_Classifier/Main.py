@@ -1,28 +1,166 @@
 import random
 import scipy.io as spio
 import scipy.special
-from scipy.signal import find_peaks, butter, savgol_filter, sosfiltfilt
+from scipy.signal import find_peaks, butter, savgol_filter, sosfiltfilt, sosfilt, sosfilt_zi
+from scipy.interpolate import CubicSpline
 import matplotlib.pyplot as plt
 import numpy as np
 from sklearn import metrics
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
 from sklearn.decomposition import PCA
+from sklearn.model_selection import StratifiedKFold
 import time
 import os
+import functools
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+import glob
+import hashlib
+import inspect
+import atexit
+import csv
+import io
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+#Go to line 1996 for User inputs
+
+#Stage profiling, records the wall time, CPU time and memory of each pipeline stage as JSON lines
+class StageProfiler:
+    def __init__(self, path = None, memory = False, profile_dir = None):
+        self.configure(path, memory, profile_dir)
+
+    def configure(self, path = None, memory = False, profile_dir = None, **context):
+        # path is the JSON-lines log, nothing is recorded while it is None
+        # memory traces peak allocations with tracemalloc, which slows numpy code that allocates a lot
+        # profile_dir keeps a cProfile dump of each outermost stage, for opening with pstats or snakeviz
+        # context is added to every record, e.g. the recording being processed
+        self.path = path
+        self.memory = memory
+        self.profile_dir = profile_dir
+        self.context = context
+        # Each configured run gets its own id so runs appended to the same log can be told apart
+        self.run = time.strftime('%Y%m%d_%H%M%S') + '_' + str(os.getpid())
+        self.counts = {}
+        self.last = {}
+        self.stack = []
+        self.active_profile = None
+        if path is not None and os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return self
+
+    @contextmanager
+    def stage(self, name, **info):
+        # Time the enclosed block, yields the record so callers can add fields such as sizes
+        if self.path is None:
+            yield {}
+            return
+        record = {'run': self.run, 'stage': name, 'pid': os.getpid(), 'start': time.time()}
+        record.update(self.context)
+        record.update(info)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        frame = {'peak': 0}
+        if self.stack:
+            # Stage this one ran inside, e.g. filter_signal within classify_recording
+            record['parent'] = self.stack[-1]['name']
+        frame['name'] = name
+        if self.memory:
+            # Keep the enclosing stage's peak before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start_memory'] = current
+        self.stack.append(frame)
+        profile = None
+        if self.profile_dir is not None and self.active_profile is None:
+            # Only one cProfile can be active, so nested stages appear inside their parent's dump
+            profile = cProfile.Profile()
+            self.active_profile = profile
+            profile.enable()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - wall_start
+            record['cpu_seconds'] = time.process_time() - cpu_start
+            if profile is not None:
+                profile.disable()
+                self.active_profile = None
+                record['profile'] = os.path.join(self.profile_dir, '%s_%s_%s.prof' % (self.run, name,
+                                                                                      self.counts[name]))
+                profile.dump_stats(record['profile'])
+            self.stack.pop()
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if self.stack:
+                    self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+                # Bytes allocated above what was already held when the stage started
+                record['peak_memory'] = peak - frame['start_memory']
+            record['depth'] = len(self.stack)
+            self.write(record)
+
+    def write(self, record):
+        # One JSON object per line, opened in append mode so pool workers can share the log
+        # The latest record of each stage is also kept for callers such as the benchmark suite
+        self.last[record['stage']] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=float) + '\n')
+
+    @staticmethod
+    def summary(path):
+        # Total seconds and peak memory of each stage per run, to find the stage that regressed
+        runs = {}
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                stages = runs.setdefault(record['run'], {})
+                totals = stages.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'peak_memory': 0})
+                totals['calls'] += 1
+                totals['seconds'] += record['seconds']
+                totals['peak_memory'] = max(totals['peak_memory'], record.get('peak_memory', 0))
+        return runs
+
+
+profiler = StageProfiler()
+
+def profiled(name, size = None):
+    # Decorator timing every call of a method as a profiler stage
+    # size(self, *args) gives the number of samples or spikes handled, to compare runs on different recordings
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if profiler.path is None:
+                return method(*args, **kwargs)
+            info = {} if size is None else {'size': int(size(*args))}
+            with profiler.stage(name, **info):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorate
 
-#Go to line 441 for User inputs
 
 #Method 1 Neural Network adapted from coursework A
 class NeuralNetwork:
     # Init the network, this gets run whenever we make a new instance of this class
-    def __init__ (self, input_nodes, hidden_nodes, output_nodes, learning_rate):
+    def __init__ (self, input_nodes, hidden_nodes, output_nodes, learning_rate, dtype = np.float64):
         # Set the number of nodes in each input, hidden and output layer
         self.i_nodes = input_nodes
         self.h_nodes = hidden_nodes
         self.o_nodes = output_nodes
+        # Precision of weights and batch computations, np.float32 halves memory traffic
+        self.dtype = dtype
         # Weight matrices, wih (input -> hidden) and who (hidden -> output)
-        self.wih = np.random.normal(0.0, pow(self.h_nodes, -0.5), (self.h_nodes, self.i_nodes))
-        self.who = np.random.normal(0.0, pow(self.o_nodes, -0.5), (self.o_nodes, self.h_nodes))
+        self.wih = np.random.normal(0.0, pow(self.h_nodes, -0.5), (self.h_nodes, self.i_nodes)).astype(dtype)
+        self.who = np.random.normal(0.0, pow(self.o_nodes, -0.5), (self.o_nodes, self.h_nodes)).astype(dtype)
         # Set the learning rate
         self.lr = learning_rate
         # Set the activation function, the logistic sigmoid
@@ -51,6 +189,26 @@ class NeuralNetwork:
         # Update the weights for the links between the input and hidden layers
         self.wih += self.lr * np.dot((hidden_errors * hidden_outputs * (1.0 - hidden_outputs)),
         np.transpose(inputs_array))
+        # Train the network on a whole mini-batch at once
+    def train_batch(self, inputs_matrix, targets_matrix):
+        # Inputs are (N, input_nodes) and targets are (N, output_nodes), one row per spike
+        # Calculate signals into and out of hidden layer for every spike in one product
+        hidden_outputs = self.activation_function(np.dot(inputs_matrix, self.wih.T))
+        # Calculate signals into and out of final layer
+        final_outputs = self.activation_function(np.dot(hidden_outputs, self.who.T))
+        # Current error is (target - actual)
+        output_errors = targets_matrix - final_outputs
+        self.output_errors = output_errors
+        # Hidden layer errors are the output errors, split by the weights, recombined at hidden nodes
+        hidden_errors = np.dot(output_errors, self.who)
+        # Gradients are summed over the batch, so each spike moves the weights as far as it does in train()
+        output_delta = output_errors * final_outputs * (1.0 - final_outputs)
+        hidden_delta = hidden_errors * hidden_outputs * (1.0 - hidden_outputs)
+        step = self.dtype(self.lr)
+        # Update the weights for the links between the hidden and output layers
+        self.who += step * np.dot(output_delta.T, hidden_outputs)
+        # Update the weights for the links between the input and hidden layers
+        self.wih += step * np.dot(hidden_delta.T, inputs_matrix)
         # Query the network
     def query(self, inputs_list):
         # Convert the inputs list into a 2D array
@@ -65,54 +223,171 @@ class NeuralNetwork:
         final_outputs =self.activation_function(final_inputs)
         return final_outputs
 
+    def query_batch(self, inputs_matrix):
+        # Query the network for a whole (N, input_nodes) matrix of spikes at once
+        hidden_outputs = self.activation_function(np.dot(inputs_matrix, self.wih.T))
+        # Outputs are (N, output_nodes), one row of class scores per spike
+        final_outputs = self.activation_function(np.dot(hidden_outputs, self.who.T))
+        return final_outputs
+
+    @profiled('nn_query', lambda self, spikes, *args: len(spikes))
+    def predict_batch(self, sub_spikes, chunk_size = 10000):
+        # Classify a 2D array of spikes, returning class labels and per-class scores
+        sub_spikes = np.asarray(sub_spikes, dtype=self.dtype)
+        scores = np.empty((len(sub_spikes), self.o_nodes), dtype=self.dtype)
+        # Work through the spikes in chunks so the hidden layer activations stay bounded in memory
+        for start in range(0, len(sub_spikes), chunk_size):
+            scores[start:start + chunk_size] = self.query_batch(sub_spikes[start:start + chunk_size])
+        labels = np.argmax(scores, axis=1) + 1
+        return labels, scores
+
     def predict(self, sub_spikes):
         # Used to dcreate the predictions of submission dataset classes
-        idx = 0
-        prediction = []
-        for spike in sub_spikes:
-            # Query each spike into the neural network
-            out = self.query(spike)
-            label = np.argmax(out) + 1
-            idx += 1
-            # Append Results to output array
-            prediction.append(label)
-
-        return prediction
-
-    def run(self,full_spikes, neuron_classes, iterations, training_proportion ):
+        prediction, scores = self.predict_batch(sub_spikes)
+        return list(prediction)
+
+    @profiled('nn_train', lambda self, spikes, *args: len(spikes))
+    def fit(self, training_data, training_classes, iterations, batch_size = 1, shuffle = True, validation_data = None,
+            validation_classes = None, patience = None, lr_decay = 1.0, checkpoint = None):
+        # Train the network on every given spike for a number of epochs
+        # With validation data the accuracy is checked after every epoch, training stops once it has not improved
+        # for patience epochs and the best weights are kept
+        # lr_decay multiplies the learning rate after every epoch
+        # checkpoint is an .npz file written after every epoch, an interrupted run with the same settings
+        # and data sizes resumes from it, anything else starts afresh and overwrites it
+        output_nodes = self.o_nodes
+        # Start counter
+        a = 0
+        best_accuracy = -1.0
+        best_weights = None
+        stale = 0
+        self.history = []
+        training_data = np.asarray(training_data, dtype=self.dtype)
+        training_classes = np.asarray(training_classes)
+        # Everything a resumed run must share with the run that wrote the checkpoint
+        config = {'iterations': iterations, 'samples': len(training_data),
+                  'validation_samples': 0 if validation_data is None else len(validation_data),
+                  'nodes': [self.i_nodes, self.h_nodes, self.o_nodes], 'learning_rate': self.lr,
+                  'batch_size': batch_size, 'shuffle': shuffle, 'patience': patience, 'lr_decay': lr_decay,
+                  'dtype': np.dtype(self.dtype).name}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            progress = self.load_checkpoint(checkpoint, config)
+            if progress is not None:
+                a, best_accuracy, best_weights, stale = progress
+                print('Resuming from epoch %s of %s' % (a, checkpoint))
+        # Create target matrix for all spikes, with 0.99 as the correct class
+        targets = np.zeros((len(training_data), output_nodes), dtype=self.dtype) + 0.01
+        targets[np.arange(len(training_data)), training_classes - 1] = 0.99
+        while a < iterations and (patience is None or stale < patience):
+            a += 1
+            epoch_start = time.time()
+            # Visit the training spikes in a new random order each epoch
+            if shuffle:
+                order = np.random.permutation(len(training_data))
+            else:
+                order = np.arange(len(training_data))
+            # Train on each mini-batch of spikes
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                self.train_batch(training_data[batch], targets[batch])
+            epoch = {'epoch': a, 'seconds': time.time() - epoch_start, 'learning_rate': self.lr}
+            if validation_data is not None:
+                epoch['accuracy'] = metrics.accuracy_score(validation_classes, self.classify(validation_data))
+                if epoch['accuracy'] > best_accuracy:
+                    best_accuracy = epoch['accuracy']
+                    best_weights = (self.wih.copy(), self.who.copy())
+                    stale = 0
+                else:
+                    stale += 1
+            self.history.append(epoch)
+            self.lr *= lr_decay
+            # Print epoch and its duration to monitor progress
+            if validation_data is not None:
+                print('Epoch %s/%s: %.3fs, validation accuracy %.4f' % (a, iterations, epoch['seconds'],
+                                                                         epoch['accuracy']))
+            else:
+                print('Epoch %s/%s: %.3fs' % (a, iterations, epoch['seconds']))
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint, a, best_accuracy, best_weights, stale, config)
+        if checkpoint is not None:
+            # A finished run is never resumed, the next run with this checkpoint trains from the start
+            self.save_checkpoint(checkpoint, a, best_accuracy, best_weights, stale, config, finished = True)
+        if patience is not None and stale >= patience:
+            print('Stopped early, no improvement for %s epochs' % patience)
+        if best_weights is not None:
+            # Finish on the epoch with the best validation accuracy
+            self.wih, self.who = best_weights
+        return self
+
+    def save_checkpoint(self, path, epoch, best_accuracy, best_weights, stale, config, finished = False):
+        # Write the weights and training progress to a temporary file and move it into place,
+        # so an interruption mid-write leaves the previous checkpoint intact
+        arrays = {'wih': self.wih, 'who': self.who}
+        if best_weights is not None:
+            arrays['best_wih'], arrays['best_who'] = best_weights
+        progress = {'epoch': epoch, 'learning_rate': self.lr, 'best_accuracy': best_accuracy, 'stale': stale,
+                    'config': config, 'finished': finished}
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, progress=json.dumps(progress), **arrays)
+        os.replace(temp_path, path)
+
+    def load_checkpoint(self, path, config):
+        # Restore weights and learning rate from save_checkpoint, returns the epoch, best accuracy,
+        # best weights and epochs without improvement, or None if the checkpoint is from a finished run
+        # or one with different settings
+        with np.load(path) as stored:
+            progress = json.loads(str(stored['progress']))
+            if progress.get('finished', False):
+                print('Checkpoint ' + path + ' is from a finished run, training from the start')
+                return None
+            # Compare through json so tuples and lists, ints and floats match as they were saved
+            if progress.get('config') != json.loads(json.dumps(config)):
+                print('Checkpoint ' + path + ' has different settings or data, training from the start')
+                return None
+            self.wih = stored['wih'].astype(self.dtype)
+            self.who = stored['who'].astype(self.dtype)
+            best_weights = None
+            if 'best_wih' in stored.files:
+                best_weights = (stored['best_wih'].astype(self.dtype), stored['best_who'].astype(self.dtype))
+        self.lr = progress['learning_rate']
+        return progress['epoch'], progress['best_accuracy'], best_weights, progress['stale']
+
+    def classify(self, spikes):
+        # Class labels for a (N, window) spike matrix, shared interface with KNearestNeighbor
+        labels, scores = self.predict_batch(spikes)
+        return labels
+
+    def run(self,full_spikes, neuron_classes, iterations, training_proportion, batch_size = 1, shuffle = True,
+            patience = None, lr_decay = 1.0, checkpoint = None, stopping_proportion = 0.1):
         # This function sets up and run iteration loop for neural net training
+        # patience, lr_decay and checkpoint are passed to fit
+        # With patience, stopping_proportion of the training spikes are held out for early stopping, so the
+        # validation spikes the metrics are reported on play no part in choosing the weights
         # Start the timer
         time_start = time.time()
-        output_nodes = 5
-        # Start counter
-        a = 0
+        # Stack spikes into an (N, window) matrix so each batch is a single slice
+        full_spikes = np.asarray(full_spikes, dtype=self.dtype)
+        neuron_classes = np.asarray(neuron_classes)
         # Split data into separate training and validation sets, based on given proportion
-        training_data = full_spikes[0:(int(len(full_spikes) * training_proportion))]
-        validation_data = full_spikes[((int(len(full_spikes) * training_proportion))):]
-        test_targets = neuron_classes[((int(len(full_spikes) * training_proportion))):]
-        while a < iterations:
-            a += 1
-            # Print iteration to monitor progress
-            print(a)
-            # Index counter
-            idx = 0
-            for spike in training_data:
-                # Create target array for each spike, with 0.99 as the correct class
-                targets = np.zeros(output_nodes) + 0.01
-                targets[neuron_classes[idx] - 1] = 0.99
-                idx += 1
-                self.train(spike, targets)
-        idx = 0
-        # Initiate prediction array
-        prediction = []
+        split = int(len(full_spikes) * training_proportion)
+        training_data = full_spikes[0:split]
+        training_classes = neuron_classes[0:split]
+        validation_data = full_spikes[split:]
+        test_targets = neuron_classes[split:]
+        stopping_data = None
+        stopping_classes = None
+        if patience is not None:
+            stop_split = int(split * (1 - stopping_proportion))
+            stopping_data = training_data[stop_split:]
+            stopping_classes = training_classes[stop_split:]
+            training_data = training_data[:stop_split]
+            training_classes = training_classes[:stop_split]
+        self.fit(training_data, training_classes, iterations, batch_size, shuffle, stopping_data, stopping_classes,
+                 patience, lr_decay, checkpoint)
         #Validation phase
-        for spike in validation_data:
-            # Query each validation spike
-            out = self.query(spike)
-            #Find label output
-            label = np.argmax(out) + 1
-            idx += 1
-            #Append label to output array
+        # Query all validation spikes in one pass and find label outputs
+        prediction, scores = self.predict_batch(validation_data)
         # Stop timer
         time_end = time.time()
         time_elapsed = time_end-time_start
@@ -136,10 +411,20 @@ class KNearestNeighbor:
         self.train_labels = labels[:int(len(spikes)*train_proportion)]
         self.test_labels = labels[int(len(spikes)*train_proportion):]
 
-    def create_model(self,k_neighbors,p_distance):
+    @profiled('knn_train', lambda self, *args: len(self.train_spikes))
+    def create_model(self,k_neighbors,p_distance, backend = 'auto', leaf_size = 30, n_trees = 10):
         # Generate the KNN model using the scikit-learn library
-        # Instantiate KNeighborsClassifier Class
-        self.model = KNeighborsClassifier(n_neighbors=int(k_neighbors), p=p_distance)
+        # backend is a scikit-learn algorithm ('auto', 'brute', 'kd_tree', 'ball_tree')
+        # or 'rp_forest' for the approximate RandomProjectionForest below
+        # Keep the settings so the model can be saved and rebuilt
+        self.params = {'k_neighbors': int(k_neighbors), 'p_distance': p_distance, 'backend': backend,
+                       'leaf_size': leaf_size, 'n_trees': n_trees}
+        if backend == 'rp_forest':
+            self.model = RandomProjectionForest(int(k_neighbors), p_distance, n_trees, leaf_size)
+        else:
+            # Instantiate KNeighborsClassifier Class
+            self.model = KNeighborsClassifier(n_neighbors=int(k_neighbors), p=p_distance, algorithm=backend,
+                                              leaf_size=leaf_size)
         self.model.fit(self.train_spikes, self.train_labels)
         """Fit the k-nearest neighbors classifier from the training dataset.
         Parameters
@@ -158,7 +443,7 @@ class KNearestNeighbor:
 
     def score(self):
         # Predict using knn model
-        self.prediction = self.model.predict(self.test_spikes)
+        self.prediction = self.classify(self.test_spikes)
         # Calculate accuracy score
         self.accuracy = metrics.accuracy_score(self.test_labels, self.prediction)
         # End Timer
@@ -172,19 +457,573 @@ class KNearestNeighbor:
         c_matrix = metrics.confusion_matrix(self.test_labels, self.prediction)
         print(c_matrix)
 
+    @profiled('knn_predict', lambda self, spikes: len(spikes))
+    def classify(self, spikes):
+        # Class labels for a (N, window) spike matrix, shared interface with NeuralNetwork
+        return self.model.predict(spikes)
+
     def predict(self, submission_data):
         #Generate predictions for submission classes using knn model
-        self.prediction = self.model.predict(submission_data.full_spikes)
+        self.prediction = self.classify(submission_data.full_spikes)
         return self.prediction
 
+def precision_parity(signal, labels, labels_idx, window, prom, k = 4, p = 2, hidden_nodes = 100,
+                     learning_rate = 0.05, iterations = 5, batch_size = 32, train_proportion = 0.9):
+    # Run the training pipeline in float64 and float32 and compare detections, windows and accuracy
+    results = {}
+    for dtype in (np.float64, np.float32):
+        data_set = DataSet(signal, labels, labels_idx, type = 'training', plot = False, dtype = dtype)
+        data_set.sort_spikes()
+        time_start = time.time()
+        data_set.filter_signal()
+        data_set.detect_spikes(window, prom)
+        preprocess_time = time.time() - time_start
+        knn = KNearestNeighbor(data_set.full_spikes, data_set.neuron_classes, train_proportion)
+        knn.create_model(k, p)
+        knn_accuracy = metrics.accuracy_score(knn.test_labels, knn.classify(knn.test_spikes))
+        # Same initial weights and batch order for both precisions
+        np.random.seed(0)
+        nn = NeuralNetwork(len(data_set.full_spikes[0]), hidden_nodes, 5, learning_rate, dtype)
+        split = int(len(data_set.full_spikes)*train_proportion)
+        nn_start = time.time()
+        nn.fit(data_set.full_spikes[:split], data_set.neuron_classes[:split], iterations, batch_size)
+        nn_prediction = nn.classify(data_set.full_spikes[split:])
+        nn_time = time.time() - nn_start
+        results[np.dtype(dtype).name] = {'data_set': data_set, 'knn_accuracy': knn_accuracy,
+                                         'nn_prediction': nn_prediction, 'preprocess_time': preprocess_time,
+                                         'nn_time': nn_time,
+                                         'nn_accuracy': metrics.accuracy_score(data_set.neuron_classes[split:],
+                                                                               nn_prediction)}
+    double = results['float64']
+    single = results['float32']
+    report = {'same_peaks': np.array_equal(double['data_set'].neuron_index, single['data_set'].neuron_index)}
+    if report['same_peaks']:
+        report['max_window_error'] = float(np.abs(double['data_set'].full_spikes - single['data_set'].full_spikes).max())
+        report['nn_agreement'] = float(np.mean(double['nn_prediction'] == single['nn_prediction']))
+    for name in ('knn_accuracy', 'nn_accuracy', 'preprocess_time', 'nn_time'):
+        report[name] = {'float64': double[name], 'float32': single[name]}
+    print(report)
+    return report
+
+
+#Version of the save_model file layout, stored in every file and checked on load
+model_format_version = 1
+
+def save_model(path, model, window, prom, type = 'submission', filter_params = None, features = None,
+               dtype = np.float64, align_params = None):
+    # Save a trained NeuralNetwork or KNearestNeighbor with the preprocessing it expects, in one .npz file
+    settings = {'format_version': model_format_version, 'window': [int(w) for w in window], 'prom': prom,
+                'type': type, 'dtype': np.dtype(dtype).name,
+                # Every filter and detection argument, so the file does not depend on the defaults at load time
+                'filter_params': DataSet.resolved(DataSet.apply_filters, **(filter_params or {})),
+                'align_params': DataSet.resolved(DataSet.detect_spikes, **(align_params or {}))}
+    arrays = {}
+    if isinstance(model, NeuralNetwork):
+        settings['model'] = 'nn'
+        settings['learning_rate'] = model.lr
+        arrays['wih'] = model.wih
+        arrays['who'] = model.who
+    if isinstance(model, KNearestNeighbor):
+        # A KNN model is its training spikes, the neighbour index is rebuilt on load
+        settings['model'] = 'knn'
+        settings['knn_params'] = model.params
+        arrays['train_spikes'] = model.train_spikes
+        arrays['train_labels'] = model.train_labels
+    if features is not None:
+        # Store the fitted feature extractor alongside with a prefix
+        arrays.update({'features_' + name: value for name, value in features.state().items()})
+    # Normalisation uses each recording's own filtered maximum, so the window, threshold type and
+    # filter settings are all that is needed to prepare a new recording the same way
+    np.savez_compressed(path, settings=json.dumps(settings), **arrays)
+
+def load_model(path):
+    # Load a model written by save_model, returns the model, its preprocessing settings and feature extractor
+    with np.load(path) as stored:
+        settings = json.loads(str(stored['settings']))
+        if settings['format_version'] != model_format_version:
+            raise ValueError('Model file version ' + str(settings['format_version']) + ' is not supported')
+        if settings['model'] == 'nn':
+            wih = stored['wih']
+            who = stored['who']
+            model = NeuralNetwork(wih.shape[1], wih.shape[0], who.shape[0], settings['learning_rate'], wih.dtype.type)
+            model.wih = wih
+            model.who = who
+        if settings['model'] == 'knn':
+            model = KNearestNeighbor(stored['train_spikes'], stored['train_labels'], 1.0)
+            knn_params = settings['knn_params']
+            model.create_model(knn_params['k_neighbors'], knn_params['p_distance'], knn_params['backend'],
+                               knn_params['leaf_size'], knn_params['n_trees'])
+        features = None
+        feature_state = {name[len('features_'):]: stored[name] for name in stored.files if name.startswith('features_')}
+        if feature_state:
+            features = FeatureExtractor().set_state(feature_state)
+    return model, settings, features
+
+def classify(recording, model_path, output = None):
+    # Label the spikes in a new recording with a saved model, without touching the training data
+    model, settings, features = load_model(model_path)
+    # The recording is read once, so skip the .npy conversion, which would write next to it
+    return classify_recording(recording, model, settings, features, output, memmap=False)
+
+def classify_recording(recording, model, settings, features = None, output = None, memmap = True):
+    # Label the spikes in one recording with an already loaded model
+    # .mat files are converted once and memory-mapped unless memmap is off, .npy files are mapped directly
+    # The whole recording is one profiler stage, so a slow file can be traced to its filter or detect stages
+    with profiler.stage('classify_recording', recording=recording):
+        if recording.endswith('.mat') and memmap:
+            signal = load_recording(recording)['d']
+        elif recording.endswith('.mat'):
+            signal = spio.loadmat(recording, squeeze_me=True)['d']
+        else:
+            signal = np.load(recording, mmap_mode='r')
+        data_set = DataSet(signal, type=settings['type'], plot=False, dtype=np.dtype(settings.get('dtype', 'float64')).type)
+        data_set.filter_signal(**settings['filter_params'])
+        data_set.detect_spikes(settings['window'], settings['prom'], **settings.get('align_params', {}))
+        spikes = data_set.full_spikes
+        if features is not None:
+            spikes = features.transform(spikes)
+        classes = np.asarray(model.classify(spikes))
+        index = np.asarray(data_set.neuron_index)
+        if output is not None:
+            spio.savemat(output, mdict={'Index': index, 'Class': classes})
+    return index, classes
+
+
+def batch_worker_init(model_path, profile = None):
+    # Load the model once in each worker process
+    # profile is the parent's profiler configuration, so workers log their stages to the same file
+    if profile is not None:
+        profiler.configure(*profile)
+    grid_data['model'], grid_data['settings'], grid_data['features'] = load_model(model_path)
+
+def batch_classify_file(recording, output_dir):
+    # Classify one recording in a worker and write its Index and Class to the output directory
+    output = os.path.join(output_dir, os.path.splitext(os.path.basename(recording))[0] + '_classes.mat')
+    # Each file is read once, so skip the .npy conversion
+    index, classes = classify_recording(recording, grid_data['model'], grid_data['settings'], grid_data['features'],
+                                        output, memmap=False)
+    unique, counts = np.unique(classes, return_counts=True)
+    return {'recording': recording, 'output': output, 'spikes': len(classes),
+            'counts': dict(zip(unique.tolist(), counts.tolist()))}
+
+def classify_batch(recordings, model_path, output_dir, workers = None):
+    # Classify every recording in a directory or matching a glob pattern across a process pool
+    if os.path.isdir(recordings):
+        recordings = os.path.join(recordings, '*.mat')
+    files = sorted(glob.glob(recordings))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    time_start = time.time()
+    results = []
+    profile = None
+    if profiler.path is not None:
+        profile = (profiler.path, profiler.memory, profiler.profile_dir)
+    with ProcessPoolExecutor(max_workers=workers, initializer=batch_worker_init,
+                             initargs=(model_path, profile)) as pool:
+        futures = [pool.submit(batch_classify_file, recording, output_dir) for recording in files]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print(results[-1]['recording'] + ': ' + str(results[-1]['spikes']) + ' spikes ' +
+                  str(results[-1]['counts']))
+    time_elapsed = time.time() - time_start
+    total_spikes = sum(result['spikes'] for result in results)
+    summary = {'files': len(results), 'spikes': total_spikes, 'seconds': time_elapsed,
+               'files_per_second': len(results) / time_elapsed, 'spikes_per_second': total_spikes / time_elapsed,
+               'recordings': sorted(results, key=lambda result: result['recording'])}
+    # Keep the per-file counts and throughput with the outputs
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Classified %s files, %s spikes in %.2fs (%.2f files/s, %.0f spikes/s)' % (
+        len(results), total_spikes, time_elapsed, summary['files_per_second'], summary['spikes_per_second']))
+    return summary
+
+
+#Approximate nearest neighbour index for KNearestNeighbor
+class RandomProjectionForest:
+    def __init__(self, n_neighbors = 4, p = 2, n_trees = 10, leaf_size = 30, chunk_size = 256, seed = 0):
+        # Each tree splits the spikes on random hyperplanes down to leaves of at most leaf_size spikes
+        # Queries only compare against spikes sharing a leaf in some tree
+        self.n_neighbors = n_neighbors
+        self.p = p
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.chunk_size = chunk_size
+        self.random = np.random.default_rng(seed)
+
+    def build_tree(self, spikes):
+        # Tree stored as arrays, internal nodes have a split direction and value, leaves a row of spike indices
+        directions = []
+        values = []
+        children = []
+        leaves = []
+        stack = [(np.arange(len(spikes)), None, 0)]
+        while stack:
+            members, parent, side = stack.pop()
+            node = len(children)
+            children.append([-1, -1])
+            directions.append(np.zeros(spikes.shape[1]))
+            values.append(0.0)
+            leaves.append(-1)
+            if parent is not None:
+                children[parent][side] = node
+            if len(members) <= self.leaf_size:
+                leaves[node] = len(self.leaf_rows)
+                row = np.full(self.leaf_size, -1)
+                row[:len(members)] = members
+                self.leaf_rows.append(row)
+                continue
+            # Split at the median projection onto a random direction
+            direction = self.random.normal(size=spikes.shape[1])
+            projection = np.dot(spikes[members], direction)
+            value = np.median(projection)
+            left = projection <= value
+            if left.all() or not left.any():
+                # All projections equal, split in half instead
+                left = np.arange(len(members)) < len(members) // 2
+            directions[node] = direction
+            values[node] = value
+            stack.append((members[left], node, 0))
+            stack.append((members[~left], node, 1))
+        return np.array(directions), np.array(values), np.array(children), np.array(leaves)
+
+    def fit(self, spikes, labels):
+        # Distances are computed in the precision of the training spikes
+        self.spikes = np.asarray(spikes)
+        self.labels = np.asarray(labels)
+        self.classes = np.unique(self.labels)
+        self.leaf_rows = []
+        self.trees = [self.build_tree(self.spikes) for n in range(self.n_trees)]
+        self.leaf_rows = np.array(self.leaf_rows)
+        # Exact index for queries with too few candidates
+        self.exact = NearestNeighbors(n_neighbors=self.n_neighbors, p=self.p).fit(self.spikes)
+        return self
+
+    def find_leaves(self, tree, queries):
+        # Route every query down one tree together, one level per step
+        directions, values, children, leaves = tree
+        node = np.zeros(len(queries), dtype=int)
+        internal = leaves[node] < 0
+        while internal.any():
+            rows = np.where(internal)[0]
+            projection = np.einsum('ij,ij->i', queries[rows], directions[node[rows]])
+            node[rows] = np.where(projection <= values[node[rows]], children[node[rows], 0], children[node[rows], 1])
+            internal = leaves[node] < 0
+        return leaves[node]
+
+    def kneighbors(self, queries, n_neighbors = None, return_distance = True):
+        # Approximate k nearest training spikes for each query, nearest first
+        # Returns (distances, indices) as scikit-learn does, or only the indices without return_distance
+        k = self.n_neighbors if n_neighbors is None else n_neighbors
+        queries = np.asarray(queries, dtype=self.spikes.dtype)
+        neighbours = np.empty((len(queries), k), dtype=int)
+        neighbour_distances = np.empty((len(queries), k))
+        for start in range(0, len(queries), self.chunk_size):
+            chunk = queries[start:start + self.chunk_size]
+            # Candidates are all spikes sharing a leaf with the query in any tree
+            candidates = np.hstack([self.leaf_rows[self.find_leaves(tree, chunk)] for tree in self.trees])
+            candidates.sort(axis=1)
+            # Ignore padding and spikes found by more than one tree
+            invalid = candidates < 0
+            invalid[:, 1:] |= candidates[:, 1:] == candidates[:, :-1]
+            distances = np.linalg.norm(self.spikes[np.maximum(candidates, 0)] - chunk[:, None, :], ord=self.p, axis=2)
+            distances[invalid] = np.inf
+            nearest = np.argsort(distances, axis=1, kind='stable')[:, :k]
+            neighbours[start:start + self.chunk_size] = np.take_along_axis(candidates, nearest, axis=1)
+            neighbour_distances[start:start + self.chunk_size] = np.take_along_axis(distances, nearest, axis=1)
+            # Fall back to the exact index where fewer than k candidates were found
+            short = (~invalid).sum(axis=1) < k
+            if short.any():
+                exact_distances, exact_neighbours = self.exact.kneighbors(chunk[short], k)
+                neighbours[start:start + self.chunk_size][short] = exact_neighbours
+                neighbour_distances[start:start + self.chunk_size][short] = exact_distances
+        if return_distance:
+            return neighbour_distances, neighbours
+        return neighbours
+
+    def predict(self, queries):
+        # Majority vote of the approximate neighbours, ties to the lowest class
+        votes = neighbour_votes(self.labels[self.kneighbors(queries, return_distance=False)], self.classes)
+        return votes[:, -1]
+
+
+def neighbour_benchmark(spikes, labels, k = 4, p = 2, backends = ('brute', 'kd_tree', 'ball_tree', 'rp_forest'),
+                        leaf_sizes = (10, 30, 100), n_trees = 10, train_proportion = 0.9, min_recall = 0.95):
+    # Recall against exact neighbours, accuracy and query latency for each neighbour backend and leaf size
+    # Brute force has no leaf size and runs once
+    knn = KNearestNeighbor(np.asarray(spikes, dtype=float), np.asarray(labels), train_proportion)
+    exact = NearestNeighbors(n_neighbors=k, p=p, algorithm='brute').fit(knn.train_spikes)
+    exact_neighbours = exact.kneighbors(knn.test_spikes, return_distance=False)
+    results = []
+    for backend in backends:
+        for leaf_size in (leaf_sizes[:1] if backend == 'brute' else leaf_sizes):
+            fit_start = time.time()
+            knn.create_model(k, p, backend, leaf_size, n_trees)
+            fit_time = time.time() - fit_start
+            query_start = time.time()
+            neighbours = knn.model.kneighbors(knn.test_spikes, k, return_distance=False)
+            query_time = time.time() - query_start
+            # Fraction of the true k nearest found by this backend
+            recall = np.mean([len(np.intersect1d(found, true)) / k
+                              for found, true in zip(neighbours, exact_neighbours)])
+            accuracy = metrics.accuracy_score(knn.test_labels, knn.classify(knn.test_spikes))
+            results.append({'backend': backend, 'leaf_size': leaf_size, 'recall': recall, 'accuracy': accuracy,
+                            'fit_time': fit_time, 'query_time': query_time})
+            print('%s, leaf size %s: recall %.4f, accuracy %.4f, fit %.3fs, query %.3fs'
+                  % (backend, leaf_size, recall, accuracy, fit_time, query_time))
+    for backend in backends:
+        if backend != 'brute':
+            print('Best %s leaf size: %s' % (backend, tuned_leaf_size(results, backend, None, min_recall)))
+    return results
+
+
+def tuned_leaf_size(results, backend, default = 30, min_recall = 0.95):
+    # Leaf size with the fastest queries from a neighbour_benchmark run, among those finding at least
+    # min_recall of the true neighbours, or default if the backend was not benchmarked or never reached it
+    candidates = [result for result in results if result['backend'] == backend and result['recall'] >= min_recall]
+    if not candidates:
+        return default
+    return min(candidates, key=lambda result: result['query_time'])['leaf_size']
+
+
+#Feature extraction applied to spike windows before either classifier
+class FeatureExtractor:
+    def __init__(self, method = 'pca', n_components = 0.99, levels = 3):
+        # method is 'pca', 'wavelet' (haar coefficients) or 'template' (distance to each class mean)
+        # n_components is a count, or for pca and wavelet a fraction of variance to keep
+        self.method = method
+        self.n_components = n_components
+        self.levels = levels
+
+    def haar(self, spikes):
+        # Multi-level haar wavelet decomposition of every spike at once
+        coefficients = []
+        approximation = spikes
+        for level in range(self.levels):
+            if approximation.shape[1] % 2:
+                approximation = np.pad(approximation, ((0, 0), (0, 1)), mode='edge')
+            coefficients.append((approximation[:, 0::2] - approximation[:, 1::2]) / np.sqrt(2))
+            approximation = (approximation[:, 0::2] + approximation[:, 1::2]) / np.sqrt(2)
+        coefficients.append(approximation)
+        return np.hstack(coefficients[::-1])
+
+    def n_kept(self, variances):
+        # Number of components to keep, in order of decreasing variance
+        if self.n_components < 1:
+            explained = np.cumsum(variances) / np.sum(variances)
+            return int(np.searchsorted(explained, self.n_components) + 1)
+        return int(self.n_components)
+
+    def fit_key(self, spikes, labels = None):
+        # Hash of the settings and training data, a stored extractor is only reused when this matches,
+        # so a change to the components, recording, window, filtering or alignment refits it
+        digest = hashlib.sha256(json.dumps([self.method, float(self.n_components), int(self.levels)]).encode())
+        spikes = np.ascontiguousarray(spikes, dtype=float)
+        digest.update(str(spikes.shape).encode())
+        digest.update(spikes.data)
+        if labels is not None:
+            digest.update(np.ascontiguousarray(labels, dtype=np.int64).data)
+        return digest.hexdigest()[:20]
+
+    def fit(self, spikes, labels = None):
+        # Fit once on the training spikes, labels are only needed for templates
+        self.key = self.fit_key(spikes, labels)
+        spikes = np.asarray(spikes, dtype=float)
+        if self.method == 'pca':
+            pca = PCA(n_components=self.n_components).fit(spikes)
+            self.mean = pca.mean_
+            self.components = pca.components_
+        if self.method == 'wavelet':
+            # Keep the wavelet coefficients that vary most between spikes
+            variances = self.haar(spikes).var(axis=0)
+            order = np.argsort(variances)[::-1]
+            self.selected = np.sort(order[:self.n_kept(variances[order])])
+        if self.method == 'template':
+            labels = np.asarray(labels)
+            self.classes = np.unique(labels)
+            self.templates = np.array([spikes[labels == c].mean(axis=0) for c in self.classes])
+        return self
+
+    def n_features(self):
+        # Number of features produced per spike
+        if self.method == 'pca':
+            return len(self.components)
+        if self.method == 'wavelet':
+            return len(self.selected)
+        return len(self.templates)
+
+    def transform(self, spikes, chunk_size = 100000):
+        # Apply to a (N, window) spike matrix in chunks, keeping float32 input in float32
+        spikes = np.asarray(spikes)
+        if spikes.dtype != np.float32:
+            spikes = spikes.astype(np.float64)
+        features = np.empty((len(spikes), self.n_features()), dtype=spikes.dtype)
+        for start in range(0, len(spikes), chunk_size):
+            chunk = spikes[start:start + chunk_size]
+            if self.method == 'pca':
+                features[start:start + chunk_size] = np.dot(chunk - self.mean.astype(spikes.dtype),
+                                                            self.components.T.astype(spikes.dtype))
+            if self.method == 'wavelet':
+                features[start:start + chunk_size] = self.haar(chunk)[:, self.selected]
+            if self.method == 'template':
+                # Euclidean distance to each class template
+                templates = self.templates.astype(spikes.dtype)
+                distances = (np.square(chunk).sum(axis=1)[:, None] - 2*np.dot(chunk, templates.T)
+                             + np.square(templates).sum(axis=1)[None, :])
+                features[start:start + chunk_size] = np.sqrt(np.maximum(distances, 0))
+        return features
+
+    def state(self):
+        # Settings and fitted parameters as a dictionary of arrays
+        fitted = {'pca': ['mean', 'components'], 'wavelet': ['selected'], 'template': ['classes', 'templates']}
+        state = {'method': np.array(self.method), 'n_components': np.array(self.n_components),
+                 'levels': np.array(self.levels), 'key': np.array(getattr(self, 'key', ''))}
+        state.update({name: getattr(self, name) for name in fitted[self.method]})
+        return state
+
+    def set_state(self, state):
+        # Restore from a dictionary made by state
+        self.method = str(state['method'])
+        self.n_components = float(state['n_components'])
+        self.levels = int(state['levels'])
+        self.key = str(state.get('key', ''))
+        for name, value in state.items():
+            if name not in ('method', 'n_components', 'levels', 'key'):
+                setattr(self, name, value)
+        return self
+
+    def save(self, path):
+        # Store the fitted parameters in a single .npz file
+        np.savez(path, **self.state())
+
+    def load(self, path):
+        # Restore a fitted extractor written by save
+        with np.load(path) as stored:
+            self.set_state({name: stored[name] for name in stored.files})
+        return self
+
+
+def feature_tradeoff(spikes, labels, extractors, k = 4, p = 2, train_proportion = 0.9):
+    # Compare KNN accuracy and prediction time on raw windows against each feature extractor
+    spikes = np.asarray(spikes, dtype=float)
+    labels = np.asarray(labels)
+    split = int(len(spikes)*train_proportion)
+    results = []
+    for features in [None] + list(extractors):
+        name = 'raw' if features is None else features.method
+        train_spikes = spikes[:split]
+        test_spikes = spikes[split:]
+        transform_time = 0.0
+        if features is not None:
+            features.fit(train_spikes, labels[:split])
+            transform_start = time.time()
+            train_spikes = features.transform(train_spikes)
+            test_spikes = features.transform(test_spikes)
+            transform_time = time.time() - transform_start
+        model = KNeighborsClassifier(n_neighbors=k, p=p).fit(train_spikes, labels[:split])
+        predict_start = time.time()
+        prediction = model.predict(test_spikes)
+        predict_time = time.time() - predict_start
+        results.append({'features': name, 'dimensions': train_spikes.shape[1],
+                        'accuracy': metrics.accuracy_score(labels[split:], prediction),
+                        'transform_time': transform_time, 'predict_time': predict_time})
+        print('%s: %s dims, accuracy %.4f, transform %.3fs, predict %.3fs' % (name, train_spikes.shape[1],
+              results[-1]['accuracy'], transform_time, predict_time))
+    return results
+
+
+#Deferred plotting for DataSet diagnostics
+class Diagnostics:
+    def __init__(self, max_points = 20000):
+        # Plots are only recorded here and drawn when render is called
+        self.max_points = max_points
+        self.figures = []
+
+    def add_figure(self, title):
+        # Start a new figure, following calls add to it
+        self.figures.append({'title': title, 'lines': [], 'scatters': [], 'vlines': []})
+
+    def line(self, y, **kwargs):
+        self.figures[-1]['lines'].append((y, kwargs))
+
+    def scatter(self, x, y, **kwargs):
+        self.figures[-1]['scatters'].append((x, y, kwargs))
+
+    def vlines(self, x, **kwargs):
+        self.figures[-1]['vlines'].append((x, kwargs))
+
+    def decimate(self, y):
+        # Reduce long signals to a min and max per bin so spikes stay visible with far fewer points
+        y = np.asarray(y)
+        if len(y) <= self.max_points:
+            return np.arange(len(y)), y
+        bin_size = int(np.ceil(len(y) / (self.max_points // 2)))
+        n_bins = len(y) // bin_size
+        bins = y[:n_bins * bin_size].reshape(n_bins, bin_size)
+        x = np.repeat(np.arange(n_bins) * bin_size + bin_size // 2, 2)
+        y = np.column_stack([bins.min(axis=1), bins.max(axis=1)]).ravel()
+        return x, y
+
+    def render(self):
+        # Draw every recorded figure
+        for figure in self.figures:
+            a = plt.figure()
+            a.suptitle(figure['title'])
+            ax = plt.gca()
+            for x, y, kwargs in figure['scatters']:
+                ax.scatter(x, y, **kwargs)
+            for x, kwargs in figure['vlines']:
+                # One collection for all whiskers instead of an artist per line
+                ax.vlines(x, 0, 1, transform=ax.get_xaxis_transform(), **kwargs)
+            for y, kwargs in figure['lines']:
+                ax.plot(*self.decimate(y), **kwargs)
+            if any('label' in kwargs for y, kwargs in figure['lines']):
+                ax.legend()
+
+
+def load_recording(filename, dtype = np.float64, path = None):
+    # Convert a .mat recording once to .npy files, then open them memory-mapped
+    # Later loads only map the files, so DataSet can slice windows without reading the whole recording
+    # and several analyses of the same file share the page cache instead of each holding a copy
+    base = os.path.splitext(filename)[0]
+    if path is not None:
+        base = os.path.join(path, os.path.basename(base))
+    names = {'d': base + '_d_' + np.dtype(dtype).name + '.npy', 'Class': base + '_Class.npy',
+             'Index': base + '_Index.npy'}
+    # Convert again if the .mat file has changed since
+    if not os.path.exists(names['d']) or os.path.getmtime(names['d']) < os.path.getmtime(filename):
+        table = spio.loadmat(filename, squeeze_me=True)
+        for key, name in names.items():
+            if key in table:
+                array = np.asarray(table[key], dtype=dtype) if key == 'd' else np.asarray(table[key])
+                # Write to a temporary file first so a partial conversion is never mapped
+                with open(name + '.tmp', 'wb') as f:
+                    np.save(f, array)
+                os.replace(name + '.tmp', name)
+        del table
+    recording = {}
+    for key, name in names.items():
+        if os.path.exists(name):
+            recording[key] = np.load(name, mmap_mode='r')
+    return recording
+
+
 #Handle Data using this class
 class DataSet:
-    def __init__(self, data_points, labels = 0, labels_idx = 0, type = 'submission'):
+    # Bump when filtering or detection changes, so cached spikes from older code are not reused
+    detection_version = 3
+
+    def __init__(self, data_points, labels = 0, labels_idx = 0, type = 'submission', plot = True, dtype = np.float64):
         # Assign inputs to self for easy access
         self.signal = data_points
         self.all_labels = labels
         self.all_labels_idx = labels_idx
         self.type = type
+        # Precision used for filtering, normalisation and spike windows, np.float32 halves memory
+        self.dtype = dtype
+        # Diagnostic plots are recorded for later rendering only when plotting is on
+        self.diagnostics = Diagnostics() if plot else None
+        # Butterworth designs by (order, cutoff, type), shared by every chunk and channel
+        self.filters = {}
 
     def sort_spikes(self):
         # Put spike labels and indices into chronological order
@@ -192,16 +1031,41 @@ class DataSet:
         self.all_labels_idx = self.all_labels_idx[sorted_args]
         self.all_labels = self.all_labels[sorted_args]
 
+    @profiled('filter_signal', lambda self, *args: len(self.signal))
     def filter_signal(self, butter_order = 3, fc_low = 30, fc_high =1900, savgol_window = 19, savgol_order = 5):
         # This function handles all signal filtering for training and submission data sets
+        filtered_signal1, filtered_signal2 = self.apply_filters(self.signal, butter_order, fc_low, fc_high,
+                                                                savgol_window, savgol_order)
+        # Set filtered signal to self for easy access
+        self.filtered_signal = filtered_signal2
+        if self.diagnostics is not None:
+            # Record figure of signal filtering progress
+            self.diagnostics.add_figure('Signal Filtering: '+ str(self.type) + '.mat')
+            self.diagnostics.line(self.signal, c='b', label = 'Raw Signal')
+            self.diagnostics.line(filtered_signal1, c='g', label = 'High Pass Butter 30hz')
+            self.diagnostics.line(filtered_signal2, c = 'r', label = 'Passband Butter: 30hz, 1900hz')
+            # This will be plotted at the end if plot flag is enabled
+
+    def design_filter(self, butter_order, fc, btype):
+        # Design a Butterworth filter once and reuse it, in the DataSet precision so scipy keeps it throughout
+        key = (butter_order, fc, btype)
+        if key not in self.filters:
+            self.filters[key] = butter(butter_order, fc, btype=btype, analog=False, output='sos',
+                                       fs=25000).astype(self.dtype)
+        return self.filters[key]
+
+    def apply_filters(self, signal, butter_order = 3, fc_low = 30, fc_high =1900, savgol_window = 19, savgol_order = 5):
+        # Filter chain shared by filter_signal, the chunked stream_spikes and each block of channels
+        # Filters run along the last axis, so signal can be one trace or a (channels, samples) array
+        signal = np.asarray(signal, dtype=self.dtype)
         # Always starts with a high pass butter filter
-        sos = butter(butter_order, fc_low, btype='high', analog=False, output='sos', fs=25000)
+        sos = self.design_filter(butter_order, fc_low, 'high')
         # Apply filter forwards and backwards using sosfiltfilt
-        filtered_signal1 = sosfiltfilt(sos, self.signal)
+        filtered_signal1 = sosfiltfilt(sos, signal)
         # Different options of 2nd filters for submission and training data sets due to different noise profiles
         if self.type == 'submission':
             # High pass butter filter
-            sos = butter(butter_order, fc_high, btype='low', analog=False, output='sos', fs=25000)
+            sos = self.design_filter(butter_order, fc_high, 'low')
             # Apply filter forwards and backwards using sosfiltfilt
             filtered_signal2 = sosfiltfilt(sos,filtered_signal1)
         if self.type == 'training':
@@ -212,17 +1076,77 @@ class DataSet:
             #sos = butter(butter_order, fc_high, btype='low', analog=False, output='sos', fs=25000)
             # Apply filter forwards and backwards using sosfiltfilt
             #filtered_signal2 = sosfiltfilt(sos, filtered_signal1)
-        # Set filtered signal to self for easy access
-        self.filtered_signal = filtered_signal2
-        # Plot figure of signal filtering progress
-        a = plt.figure()
-        a.suptitle('Signal Filtering: '+ str(self.type) + '.mat')
-        plt.plot(self.signal, c='b', label = 'Raw Signal')
-        plt.plot(filtered_signal1, c='g', label = 'High Pass Butter 30hz')
-        plt.plot(filtered_signal2, c = 'r', label = 'Passband Butter: 30hz, 1900hz')
-        plt.legend()
-        # This will be plotted at the end if plot flag is enabled
+        return filtered_signal1, filtered_signal2
+
+    def filter_chunks(self, chunk_size, overlap, **filter_params):
+        # Filter the signal one chunk at a time, padding each chunk with overlap samples on both sides
+        # so the zero-phase filters settle before the part of the chunk that is kept
+        n_samples = len(self.signal)
+        for start in range(0, n_samples, chunk_size):
+            end = min(start + chunk_size, n_samples)
+            padded_start = max(start - overlap, 0)
+            padded_end = min(end + overlap, n_samples)
+            # Only this slice is read, so self.signal can be a memory-mapped array
+            filtered_signal1, filtered_signal2 = self.apply_filters(np.asarray(self.signal[padded_start:padded_end]),
+                                                                    **filter_params)
+            yield start, end, padded_start, filtered_signal2
+
+    def stream_spikes(self, window, prom, chunk_size = 250000, overlap = 25000, threshold = None, scale = None,
+                      align = None, search = (5, 5), upsample = 4, refractory = None, **filter_params):
+        # Chunked version of filter_signal, normalize_data and detect_spikes for recordings larger than RAM
+        # Yields (peak_indices, spike_windows) for each chunk, so memory stays constant in recording length
+        # align, search, upsample and refractory work as in detect_spikes
+        if threshold is None or scale is None:
+            # First pass: gather the whole-signal std and max used for the threshold and normalisation
+            n_samples = 0
+            total = 0.0
+            total_sq = 0.0
+            signal_max = -np.inf
+            for start, end, padded_start, filtered in self.filter_chunks(chunk_size, overlap, **filter_params):
+                core = filtered[start - padded_start:end - padded_start]
+                n_samples += len(core)
+                total += core.sum()
+                total_sq += np.square(core).sum()
+                signal_max = max(signal_max, core.max())
+            mean = total / n_samples
+            std = np.sqrt(max(total_sq / n_samples - mean ** 2, 0.0))
+            if threshold is None:
+                # Same thresholds as detect_spikes
+                if self.type == 'submission':
+                    threshold = 1.35*std
+                if self.type == 'training':
+                    threshold = std
+            if scale is None:
+                scale = signal_max
+        self.threshold = threshold
+        before = window[0]
+        after = window[1]
+        if align is not None:
+            before += search[0] + 1
+            after += search[1] + 1
+        # Second pass: detect, align and deduplicate peaks over each padded chunk but keep only those inside
+        # the chunk itself, so peaks near a boundary see the same neighbourhood as in the full signal
+        # and are reported once
+        for start, end, padded_start, filtered in self.filter_chunks(chunk_size, overlap, **filter_params):
+            peak_indices, peak_height = find_peaks(filtered, height=threshold, prominence=prom)
+            # Drop peaks whose window, or alignment search, would run off the padded chunk, which
+            # reaches the ends of the recording for the first and last chunks
+            in_bounds = (peak_indices - before >= 0) & (peak_indices + after <= len(filtered))
+            peak_indices = peak_indices[in_bounds]
+            positions = peak_indices.astype(float)
+            amplitudes = filtered[peak_indices]
+            if align is not None:
+                positions, amplitudes = self.align_peaks(filtered, peak_indices, align, search, upsample)
+            keep = np.ones(len(peak_indices), dtype=bool)
+            if refractory is not None:
+                keep = self.refractory_mask(positions, amplitudes, refractory)
+            keep &= (peak_indices + padded_start >= start) & (peak_indices + padded_start < end)
+            # Cut all windows from this chunk in one step and normalise them as normalize_data does
+            spike_windows = self.cut_windows(filtered, positions[keep], window)
+            spike_windows = (spike_windows / self.dtype(scale) * 0.99) + 0.009
+            yield peak_indices[keep] + padded_start, spike_windows
 
+    @profiled('normalize_data', lambda self: len(self.filtered_signal))
     def normalize_data(self):
         # Make values between 0 and 1 for more compatibility with machine learning
         self.normal_signal = self.filtered_signal - self.filtered_signal.min()
@@ -230,63 +1154,162 @@ class DataSet:
         self.normal_signal = (self.normal_signal * 0.99) + 0.009
 
 
-    def detect_spikes(self, window, prom):
-        # Use fine_peaks function for peak detection
-        # Different peak thresholds for submission and trainging sets due to different noise profile
-        if self.type == 'submission':
-            self.threshold = 1.35*np.std(self.filtered_signal)
-        if self.type == 'training':
-            self.threshold = np.std(self.filtered_signal)
-            # Find peak indices and heights
-        peak_indices, peak_height = find_peaks(self.filtered_signal, height=(self.threshold),
-                                               prominence=prom)  # need prominence to prevent small sub-spikes on spike from being detected
-        print('peaks found:' + str(len(peak_indices)))
-        # Initiate output lists
-        self.full_spikes = []
-        self.neuron_classes = []
-        self.neuron_index = []
-        self.duplicates = []
-        self.normalize_data()
-        # Separate process for trainging and submission data sets
-        if self.type == 'training':
-            # loop through each peak
-            for detected_index in peak_indices:
-                # find corresponding index in training data
-                i = self.all_labels_idx[self.all_labels_idx < detected_index].max()
-                # Detect duplicates and note them into duplicates list
-                if i in self.neuron_index:
-                    self.duplicates.append(i)
-                else:
-                    # find neuron class
-                    neuron_class = self.all_labels[np.where(self.all_labels_idx == i)[0]]
-                    # Create window for spike
-                    full_spike = self.normal_signal[detected_index - window[0]:detected_index + window[1]]
-                    # append results
-                    self.full_spikes.append(full_spike)
-                    self.neuron_classes.extend(neuron_class)
-                    self.neuron_index.append(i)
-        if self.type == 'submission':
-            #The same process is used for submission, but without the associating with class phase.
-            for detected_index in peak_indices:
-                # Create window for spike
-                full_spike = self.normal_signal[detected_index - window[0]:detected_index + window[1]]
-                self.full_spikes.append(full_spike)
-                self.neuron_index.append(detected_index)
-        # Plot duplicates to troubleshoot, if they do exist
-        plt.scatter(self.duplicates,self.filtered_signal[self.duplicates], c='r', linewidths=10)
-        plt.figure()
-        # spike window plot
-        plt.suptitle('Peak whiskers for ' + str(self.type) +'.mat')
-        plt.scatter(peak_indices,self.filtered_signal[peak_indices], c='r', linewidths=2)
-        #Create vertical window whiskers
-        for index in peak_indices:
-            plt.axvline(x=index-window[0], c='r', linestyle = 'dotted', alpha = 0.7)
-            plt.axvline(x=index + window[1], c='r', linestyle = 'dotted', alpha = 0.7)
-        plt.plot(self.filtered_signal, c = 'g')
+    @staticmethod
+    def align_peaks(signal, peak_indices, align = 'peak', search = (5, 5), upsample = 4):
+        # Find the sub-sample position of the maximum (peak) or minimum (trough) near each detected peak
+        # search samples before and after the peak, on a cubic spline upsampled by upsample, all peaks at once
+        offsets = np.arange(-search[0], search[1] + 1)
+        segments = signal[peak_indices[:, None] + offsets]
+        fine = np.linspace(0, len(offsets) - 1, (len(offsets) - 1) * upsample + 1)
+        upsampled = CubicSpline(np.arange(len(offsets)), segments, axis=1)(fine)
+        if align == 'trough':
+            best = np.argmin(upsampled, axis=1)
+        else:
+            best = np.argmax(upsampled, axis=1)
+        positions = peak_indices - search[0] + fine[best]
+        amplitudes = np.abs(upsampled[np.arange(len(best)), best])
+        return positions, amplitudes
+
+    @staticmethod
+    def refractory_mask(positions, amplitudes, refractory):
+        # Keep the largest detection, drop every other within refractory samples of it, and repeat with the
+        # largest left, so a train of spikes each closer than refractory to the last is not merged into one
+        order = np.argsort(positions, kind='stable')
+        keep = np.ones(len(positions), dtype=bool)
+        # Only runs of detections chained by gaps below refractory can suppress each other
+        group = np.zeros(len(positions), dtype=int)
+        group[order[1:]] = np.cumsum(np.diff(positions[order]) > refractory)
+        group_sizes = np.bincount(group)
+        suppressed = np.zeros(len(positions), dtype=bool)
+        for members in np.split(order, np.cumsum(group_sizes)[:-1]):
+            if len(members) == 1:
+                continue
+            # Greedy suppression within the run, largest amplitude first
+            ranked = members[np.argsort(-amplitudes[members], kind='stable')]
+            for index in ranked:
+                if suppressed[index]:
+                    keep[index] = False
+                    continue
+                suppressed[members[np.abs(positions[members] - positions[index]) <= refractory]] = True
+        return keep
+
+    @staticmethod
+    def cut_windows(signal, positions, window):
+        # Gather (N, window) spike windows, linearly interpolated for sub-sample positions
+        offsets = np.arange(-window[0], window[1])
+        base = np.floor(positions).astype(int)
+        frac = (positions - base).astype(signal.dtype)[:, None]
+        indices = base[:, None] + offsets
+        if not frac.any():
+            return signal[indices]
+        return signal[indices] * (1 - frac) + signal[np.minimum(indices + 1, len(signal) - 1)] * frac
+
+    @profiled('detect_spikes', lambda self, *args: len(self.filtered_signal))
+    def detect_spikes(self, window, prom, align = None, search = (5, 5), upsample = 4, refractory = None):
+        # align is None, 'peak' or 'trough' to cut windows around the upsampled extreme near each peak
+        # refractory drops all but the largest of detections closer than this many samples, at the aligned
+        # positions if align is set and the raw peaks otherwise
+        # Each part is a profiler stage of its own, within detect_spikes
+        with profiler.stage('detect'):
+            # Use fine_peaks function for peak detection
+            # Different peak thresholds for submission and trainging sets due to different noise profile
+            if self.type == 'submission':
+                self.threshold = 1.35*np.std(self.filtered_signal)
+            if self.type == 'training':
+                self.threshold = np.std(self.filtered_signal)
+                # Find peak indices and heights
+            peak_indices, peak_height = find_peaks(self.filtered_signal, height=(self.threshold),
+                                                   prominence=prom)  # need prominence to prevent small sub-spikes on spike from being detected
+            print('peaks found:' + str(len(peak_indices)))
+            self.normalize_data()
+            # Drop peaks whose window, or alignment search, would run off either end of the signal
+            before = window[0]
+            after = window[1]
+            if align is not None:
+                before += search[0] + 1
+                after += search[1] + 1
+            in_bounds = (peak_indices - before >= 0) & (peak_indices + after <= len(self.normal_signal))
+            peak_indices = peak_indices[in_bounds]
+            # Positions the windows are cut at, moved to the aligned extreme if alignment is on
+            positions = peak_indices.astype(float)
+            amplitudes = self.filtered_signal[peak_indices]
+            if align is not None:
+                positions, amplitudes = self.align_peaks(self.filtered_signal, peak_indices, align, search, upsample)
+            if refractory is not None:
+                keep = self.refractory_mask(positions, amplitudes, refractory)
+                print('Refractory duplicates removed:' + str(len(keep) - keep.sum()))
+                peak_indices = peak_indices[keep]
+                positions = positions[keep]
+            self.duplicates = np.array([], dtype=int)
+        with profiler.stage('associate'):
+            # Separate process for trainging and submission data sets
+            if self.type == 'training':
+                # find corresponding index in training data, the last label before each peak
+                # all_labels_idx is sorted by sort_spikes so a binary search does this for every peak at once
+                label_pos = np.searchsorted(self.all_labels_idx, peak_indices, side='left') - 1
+                # Peaks before the first label have no class
+                has_label = label_pos >= 0
+                peak_indices = peak_indices[has_label]
+                label_pos = label_pos[has_label]
+                # Peaks are in order, so later peaks matched to the same label sit next to each other
+                # Keep the first and note the rest into duplicates
+                first = np.ones(len(label_pos), dtype=bool)
+                first[1:] = label_pos[1:] != label_pos[:-1]
+                self.duplicates = self.all_labels_idx[label_pos[~first]]
+                peak_indices = peak_indices[first]
+                positions = positions[has_label][first]
+                label_pos = label_pos[first]
+                # find neuron class
+                self.neuron_classes = self.all_labels[label_pos]
+                self.neuron_index = self.all_labels_idx[label_pos]
+            if self.type == 'submission':
+                #The same process is used for submission, but without the associating with class phase.
+                self.neuron_index = peak_indices
+        with profiler.stage('window'):
+            # Create all spike windows in one (N, window) gather
+            self.full_spikes = self.cut_windows(self.normal_signal, positions, window)
+        if self.diagnostics is not None:
+            # Plot duplicates to troubleshoot, if they do exist
+            if self.diagnostics.figures:
+                self.diagnostics.scatter(self.duplicates,self.filtered_signal[self.duplicates], c='r', linewidths=10)
+            # spike window plot
+            self.diagnostics.add_figure('Peak whiskers for ' + str(self.type) +'.mat')
+            self.diagnostics.scatter(peak_indices,self.filtered_signal[peak_indices], c='r', linewidths=2)
+            #Create vertical window whiskers
+            self.diagnostics.vlines(np.concatenate([peak_indices - window[0], peak_indices + window[1]]),
+                                    colors='r', linestyles = 'dotted', alpha = 0.7)
+            self.diagnostics.line(self.filtered_signal, c = 'g')
         print('Duplicate peaks:' + str(len(self.duplicates)))
 
         #plt.show()
 
+    @staticmethod
+    def resolved(method, **params):
+        # Every keyword argument of method with its default filled in where not given, so stored settings
+        # describe the processing exactly even after a default changes
+        settings = {name: parameter.default for name, parameter in inspect.signature(method).parameters.items()
+                    if parameter.default is not inspect.Parameter.empty}
+        unknown = set(params) - set(settings)
+        if unknown:
+            raise TypeError(method.__name__ + ' has no arguments ' + ', '.join(sorted(unknown)))
+        settings.update(params)
+        return settings
+
+    def process(self, window, prom, cache = None, source = None, align_params = None, **filter_params):
+        # Filter and detect spikes, starting from the on-disk cache when the source file and settings match
+        # align_params are passed to detect_spikes
+        align_params = align_params or {}
+        if cache is not None:
+            # Key on every filter and detection argument, not just those given here
+            key = cache.key(source, self.type, window, prom, self.resolved(self.apply_filters, **filter_params),
+                            self.dtype, self.resolved(self.detect_spikes, **align_params), self.detection_version)
+            if cache.load(key, self):
+                return
+        self.filter_signal(**filter_params)
+        self.detect_spikes(window, prom, **align_params)
+        if cache is not None:
+            cache.save(key, self)
+
     def plot_signal(self,d):
         #Simple plot function
         plt.axhline(y=self.threshold, color='r', linestyle='-')
@@ -300,59 +1323,469 @@ class DataSet:
         std = s.std(axis=0, ddof=0)
         print(np.where(std == 0, 0, mean / std))
 
-    def analyse_detected_peaks(self):
+    def analyse_detected_peaks(self, plot = True):
         # Detect, count and plot which peaks are missing from the 'neuron_index' array of detected spikes
-        self.missing_index = []
-        # Scan through all labels for ones that do not exist in the detected neurons index
-        for idx in self.all_labels_idx:
-            exists = idx in self.neuron_index
-            if exists == False:
-                self.missing_index.append(idx)
+        # Mask of labels that do not exist in the detected neurons index
+        missing_mask = ~np.isin(self.all_labels_idx, self.neuron_index)
+        self.missing_index = self.all_labels_idx[missing_mask]
         #Get total missing spikes to inform user in console
         self.total_missing_spikes = len(self.missing_index)
-        print('There are ' + str(len(self.missing_index)) + ' missing spikes from training data!')
-        missing_args = []
+        print('There are ' + str(self.total_missing_spikes) + ' missing spikes from training data!')
         #See which classes these missing spikes belong to
-        for index in self.missing_index:
-            missing_args.extend(list(np.where(self.all_labels_idx == index)[0]))
         # Pack these classes into a dictionary and print it
-        missing_classes = np.array(self.all_labels[missing_args])
-        unique, counts = np.unique(missing_classes, return_counts=True)
+        unique, counts = np.unique(self.all_labels[missing_mask], return_counts=True)
+        missing_classes = dict(zip(unique.tolist(), counts.tolist()))
         print('Missing classes count:')
-        print(dict(zip(unique, counts)))
+        print(missing_classes)
         # Calculate detection percentage, to be used to calculate overall accuracy
-        detection_percent = (len(self.all_labels)-len(missing_args))/len(self.all_labels)
+        detection_percent = (len(self.all_labels)-self.total_missing_spikes)/len(self.all_labels)
         print('Peak detection Percentage: ' + str(detection_percent))
-        # Plot missing peaks on the signal graph
-        b = plt.figure()
-        b.suptitle('Missing Peaks')
-        plt.scatter(self.missing_index, self.normal_signal[self.missing_index], c='r')
-        plt.plot(self.normal_signal, alpha = 0.5)
+        if plot and self.diagnostics is not None:
+            # Plot missing peaks on the signal graph
+            self.diagnostics.add_figure('Missing Peaks')
+            self.diagnostics.scatter(self.missing_index, self.normal_signal[self.missing_index], c='r')
+            self.diagnostics.line(self.normal_signal, alpha = 0.5)
+        # Return report for use in tuning loops
+        return {'missing_index': self.missing_index, 'missing_classes': missing_classes,
+                'detection_percent': detection_percent}
+
+
+#Multi-electrode recordings, a (channels, samples) signal filtered and searched for spikes on every channel
+class MultiChannelDataSet(DataSet):
+    def __init__(self, data_points, type = 'submission', dtype = np.float64, channel_positions = None, radius = 1.0,
+                 workers = None, block_channels = 8):
+        # channel_positions is (channels,) or (channels, 2) electrode coordinates, by default a linear probe
+        # with unit spacing, detections on channels within radius of each other can be the same spike
+        DataSet.__init__(self, data_points, type = type, plot = False, dtype = dtype)
+        self.n_channels = self.signal.shape[0]
+        if channel_positions is None:
+            channel_positions = np.arange(self.n_channels)
+        channel_positions = np.asarray(channel_positions, dtype=float).reshape(self.n_channels, -1)
+        distances = np.sqrt(np.square(channel_positions[:, None] - channel_positions[None]).sum(axis=2))
+        self.neighbours = distances <= radius
+        # find_peaks and the sosfiltfilt and savgol loops release the GIL, so threads run channels in parallel
+        self.workers = workers
+        self.block_channels = block_channels
+
+    @profiled('filter_signal', lambda self, *args: self.signal.size)
+    def filter_signal(self, **filter_params):
+        # Filter blocks of channels along the sample axis in a thread pool, into one preallocated array
+        self.filtered_signal = np.empty(self.signal.shape, dtype=self.dtype)
+        def filter_block(start):
+            # Only these rows are read, so self.signal can be a memory-mapped array
+            block = np.asarray(self.signal[start:start + self.block_channels])
+            self.filtered_signal[start:start + self.block_channels] = self.apply_filters(block, **filter_params)[1]
+        # Design the filters apply_filters will use before the threads start, so they share one design
+        settings = self.resolved(self.apply_filters, **filter_params)
+        self.design_filter(settings['butter_order'], settings['fc_low'], 'high')
+        if self.type == 'submission':
+            self.design_filter(settings['butter_order'], settings['fc_high'], 'low')
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(filter_block, range(0, self.n_channels, self.block_channels)))
+
+    @profiled('normalize_data', lambda self: self.filtered_signal.size)
+    def normalize_data(self):
+        # Per-channel scale, applied to the spike windows only instead of a second copy of every channel
+        self.scales = self.filtered_signal.max(axis=1)
+
+    def detect_channel(self, channel, window, prom):
+        # Threshold and find peaks on one channel, dropping those whose window runs off the recording
+        filtered = self.filtered_signal[channel]
+        # Same thresholds as detect_spikes, from this channel's own noise
+        if self.type == 'submission':
+            threshold = 1.35*np.std(filtered)
+        else:
+            threshold = np.std(filtered)
+        peak_indices, peak_height = find_peaks(filtered, height=threshold, prominence=prom)
+        in_bounds = (peak_indices - window[0] >= 0) & (peak_indices + window[1] <= len(filtered))
+        return threshold, peak_indices[in_bounds], peak_height['peak_heights'][in_bounds]
+
+    def cross_channel_mask(self, positions, channels, amplitudes, dedup_window):
+        # A detection is kept if no detection on a neighbouring channel, or its own, within dedup_window samples
+        # is larger, so a spike seen on several electrodes is kept once at the electrode where it is largest
+        order = np.lexsort((channels, positions))
+        positions = positions[order]
+        channels = channels[order]
+        amplitudes = amplitudes[order]
+        keep = np.ones(len(positions), dtype=bool)
+        lag = 1
+        # Compare each detection with the lag-th one after it, until no pair is close enough in time
+        while lag < len(positions):
+            close = positions[lag:] - positions[:-lag] <= dedup_window
+            if not close.any():
+                break
+            close &= self.neighbours[channels[:-lag], channels[lag:]]
+            # Ties go to the earlier detection
+            later_larger = amplitudes[lag:] > amplitudes[:-lag]
+            keep[:-lag][close & later_larger] = False
+            keep[lag:][close & ~later_larger] = False
+            lag += 1
+        mask = np.empty(len(keep), dtype=bool)
+        mask[order] = keep
+        return mask
+
+    @profiled('detect_spikes', lambda self, *args: self.filtered_signal.size)
+    def detect_spikes(self, window, prom, dedup_window = 10):
+        # Detect on every channel in a thread pool, remove cross-channel duplicates and build one spike table
+        # ordered by time, with the window cut from the channel the spike was largest on
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            detections = list(pool.map(lambda channel: self.detect_channel(channel, window, prom),
+                                       range(self.n_channels)))
+        self.threshold = np.array([detection[0] for detection in detections])
+        positions = np.concatenate([detection[1] for detection in detections])
+        amplitudes = np.concatenate([detection[2] for detection in detections])
+        channels = np.repeat(np.arange(self.n_channels), [len(detection[1]) for detection in detections])
+        print('peaks found:' + str(len(positions)))
+        keep = self.cross_channel_mask(positions, channels, amplitudes, dedup_window)
+        print('Cross-channel duplicates removed:' + str(len(keep) - keep.sum()))
+        order = np.lexsort((channels[keep], positions[keep]))
+        self.neuron_index = positions[keep][order]
+        self.channels = channels[keep][order]
+        self.amplitudes = amplitudes[keep][order]
+        self.normalize_data()
+        # Gather every window from its own channel in one step and normalise it as normalize_data does
+        offsets = np.arange(-window[0], window[1])
+        spike_windows = self.filtered_signal[self.channels[:, None], self.neuron_index[:, None] + offsets]
+        self.full_spikes = (spike_windows / self.scales[self.channels][:, None] * 0.99) + 0.009
+        # One row per spike: sample index, channel and peak height on that channel
+        self.spike_table = np.rec.fromarrays([self.neuron_index, self.channels, self.amplitudes],
+                                             names='index,channel,amplitude')
+
+    def classify(self, model, features = None):
+        # Label every spike in the table with a trained model, returning (index, channel, class) rows
+        spikes = self.full_spikes
+        if features is not None:
+            spikes = features.transform(spikes)
+        classes = np.asarray(model.classify(spikes))
+        return np.rec.fromarrays([self.neuron_index, self.channels, classes], names='index,channel,class')
+
+
+class OnlineSpikeSorter:
+    # Causal version of the DataSet pipeline for classifying spikes live as samples arrive
+    def __init__(self, model, window, prom, scale, type = 'submission', threshold_factor = None,
+                 noise_window = 125000, noise_update = 25000, butter_order = 3, fc_low = 30, fc_high = 1900,
+                 fs = 25000, features = None, delay = None, pulse_width = 2.0, align = None, search = (5, 5),
+                 upsample = 4, refractory = None):
+        # model is a fitted NeuralNetwork or KNearestNeighbor, trained on features if an extractor is given
+        # align, search, upsample and refractory work as in detect_spikes, and should match the settings
+        # the model was trained with
+        # scale is the normalisation constant, the filtered maximum from training, as a live stream has no
+        # maximum of its own until it ends
+        # The causal filter is not zero-phase, so windows differ in shape from the offline ones,
+        # online_parity measures how much this changes the detections and classes
+        if scale is None:
+            raise ValueError('OnlineSpikeSorter needs the normalisation scale from training')
+        self.model = model
+        self.features = features
+        self.window = window
+        self.prom = prom
+        self.align = align
+        self.search = search
+        self.upsample = upsample
+        self.refractory = refractory
+        # Same threshold multipliers as detect_spikes unless given
+        if threshold_factor is None:
+            threshold_factor = 1.35 if type == 'submission' else 1.0
+        self.threshold_factor = threshold_factor
+        self.scale = scale
+        # Design the band pass once, high pass and low pass butter in series
+        # (savgol is centred so cannot be used causally)
+        sos_high = butter(butter_order, fc_low, btype='high', analog=False, output='sos', fs=fs)
+        sos_low = butter(butter_order, fc_high, btype='low', analog=False, output='sos', fs=fs)
+        self.sos = np.vstack([sos_high, sos_low])
+        # Peaks come out of the causal filter late, and are reported at the position the zero-phase
+        # offline filter would give. The delay is measured on a spike-like gaussian pulse of pulse_width samples
+        if delay is None:
+            t = np.arange(4096)
+            pulse = np.exp(-((t - 2048) / pulse_width)**2)
+            delay = np.argmax(sosfilt(self.sos, pulse)) - np.argmax(sosfiltfilt(self.sos, pulse))
+        self.delay = int(delay)
+        # Filter state carried between calls, set from the first sample received
+        self.zi = None
+        # Sliding window of recent filtered samples for the median absolute deviation noise estimate
+        self.noise_buffer = np.zeros(noise_window)
+        self.noise_fill = 0
+        self.noise_pos = 0
+        # The medians are refreshed every noise_update samples, or sooner while the buffer is still filling
+        self.noise_update = noise_update
+        self.noise_age = 0
+        self.noise_std = None
+        # Peak prominence is measured over a bounded window so a peak can be confirmed after a fixed delay
+        self.wlen = 2*(window[0] + window[1]) + 1
+        # Samples needed before and after a peak to cut its window, and search for its extreme if aligning
+        self.before = window[0]
+        self.after = window[1]
+        if align is not None:
+            self.before += search[0] + 1
+            self.after += search[1] + 1
+        self.lookahead = max(self.after, self.wlen // 2)
+        # A run of detections chained closer than refractory is only decided once no later peak can join it,
+        # aligned positions can be up to the search width further apart than the raw peaks
+        self.chain_gap = None
+        if refractory is not None:
+            self.chain_gap = refractory + (search[0] + search[1] if align is not None else 0)
+        # First peak of the run being held back, None when nothing is held
+        self.held = None
+        # Latency from a peak arriving to it being emitted, in samples, for a spike with no others chained to it
+        self.latency_samples = self.lookahead + self.delay + (self.chain_gap or 0)
+        # Tail of the filtered signal kept between calls
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0
+        self.n_seen = 0
+        self.last_emitted = -1
+
+    def update_noise(self, filtered):
+        # Write newest samples into the circular noise buffer
+        filtered = filtered[-len(self.noise_buffer):]
+        positions = (self.noise_pos + np.arange(len(filtered))) % len(self.noise_buffer)
+        self.noise_buffer[positions] = filtered
+        self.noise_pos = (self.noise_pos + len(filtered)) % len(self.noise_buffer)
+        self.noise_fill = min(self.noise_fill + len(filtered), len(self.noise_buffer))
+        self.noise_age += len(filtered)
+        if self.noise_std is not None and self.noise_age < min(self.noise_update, self.noise_fill // 2):
+            return
+        self.noise_age = 0
+        # Robust noise level, MAD scaled to match the std of gaussian noise
+        noise = self.noise_buffer[:self.noise_fill]
+        self.noise_std = np.median(np.abs(noise - np.median(noise))) / 0.6745
+        self.threshold = self.threshold_factor * self.noise_std
+
+    def classify(self, spike_windows):
+        # Reuse whichever fitted model was given
+        if self.features is not None:
+            spike_windows = self.features.transform(spike_windows)
+        return self.model.classify(spike_windows)
+
+    def process(self, samples):
+        # Feed newly acquired samples, returns (index, class) pairs for spikes that can now be confirmed
+        samples = np.asarray(samples, dtype=float)
+        if len(samples) == 0:
+            return []
+        if self.zi is None:
+            # Start the filter in steady state for the first sample to avoid a start-up transient
+            self.zi = sosfilt_zi(self.sos) * samples[0]
+        filtered, self.zi = sosfilt(self.sos, samples, zi=self.zi)
+        self.update_noise(filtered)
+        self.buffer = np.concatenate([self.buffer, filtered])
+        self.n_seen += len(samples)
+        peak_indices, peak_height = find_peaks(self.buffer, height=self.threshold, prominence=self.prom,
+                                               wlen=self.wlen)
+        global_indices = peak_indices + self.buffer_start
+        # Only emit new peaks with full window and prominence context available
+        keep = (global_indices > self.last_emitted) & (global_indices + self.lookahead <= self.n_seen)
+        keep &= peak_indices - self.before >= 0
+        peak_indices = peak_indices[keep]
+        global_indices = global_indices[keep]
+        positions = peak_indices.astype(float)
+        amplitudes = self.buffer[peak_indices]
+        self.held = None
+        if self.align is not None and len(peak_indices) > 0:
+            positions, amplitudes = DataSet.align_peaks(self.buffer, peak_indices, self.align, self.search,
+                                                        self.upsample)
+        if self.refractory is not None and len(peak_indices) > 0:
+            # Hold back the last run of chained peaks until a later peak could no longer join it
+            closed = len(peak_indices)
+            if global_indices[-1] + self.chain_gap + self.lookahead > self.n_seen:
+                breaks = np.flatnonzero(np.diff(positions) > self.refractory)
+                closed = breaks[-1] + 1 if len(breaks) > 0 else 0
+            self.held = global_indices[closed] if closed < len(peak_indices) else None
+            peak_indices = peak_indices[:closed]
+            global_indices = global_indices[:closed]
+            positions = positions[:closed]
+            amplitudes = amplitudes[:closed]
+            if closed > 0:
+                # Suppressed peaks are decided too, so they count as emitted
+                self.last_emitted = global_indices[-1]
+                keep = DataSet.refractory_mask(positions, amplitudes, self.refractory)
+                peak_indices = peak_indices[keep]
+                global_indices = global_indices[keep]
+                positions = positions[keep]
+        results = []
+        if len(peak_indices) > 0:
+            spike_windows = DataSet.cut_windows(self.buffer, positions, self.window)
+            # Normalise as normalize_data does
+            spike_windows = (spike_windows / self.scale * 0.99) + 0.009
+            self.last_windows = spike_windows
+            classes = self.classify(spike_windows)
+            results = list(zip((global_indices - self.delay).tolist(), np.asarray(classes).tolist()))
+            self.last_emitted = max(self.last_emitted, global_indices[-1])
+        # Keep enough history for unconfirmed and held back peaks and their left hand context
+        keep_start = len(self.buffer) - (self.before + self.wlen + self.lookahead + 1)
+        if self.held is not None:
+            keep_start = min(keep_start, self.held - self.buffer_start - self.before - self.wlen)
+        if keep_start > 0:
+            self.buffer_start += keep_start
+            self.buffer = self.buffer[keep_start:]
+        return results
+
+
+def online_parity(signal, model, window, prom, block_size = 250, features = None, tolerance = 2,
+                  align_params = None):
+    # Run the offline submission pipeline and OnlineSpikeSorter on the same recording and compare
+    # the reported indices, the windows of spikes found by both and their classes
+    # align_params are passed to both detect_spikes and the sorter
+    align_params = align_params or {}
+    data_set = DataSet(signal, type = 'submission', plot = False)
+    data_set.filter_signal()
+    data_set.detect_spikes(window, prom, **align_params)
+    offline_spikes = data_set.full_spikes
+    if features is not None:
+        offline_spikes = features.transform(offline_spikes)
+    offline_classes = np.asarray(model.classify(offline_spikes))
+    # Offline normalisation, so window differences come from the causal filter alone
+    sorter = OnlineSpikeSorter(model, window, prom, float(data_set.filtered_signal.max()), features = features,
+                               **align_params)
+    online_index = []
+    online_classes = []
+    online_windows = []
+    for start in range(0, len(signal), block_size):
+        results = sorter.process(signal[start:start + block_size])
+        if results:
+            online_windows.append(sorter.last_windows)
+            online_index.extend(index for index, neuron_class in results)
+            online_classes.extend(neuron_class for index, neuron_class in results)
+    online_index = np.array(online_index, dtype=int)
+    online_classes = np.array(online_classes)
+    online_windows = np.concatenate(online_windows) if online_windows else np.zeros((0, sum(window)))
+    # Nearest offline peak to each online one
+    offline_index = np.asarray(data_set.neuron_index)
+    right = np.clip(np.searchsorted(offline_index, online_index), 1, len(offline_index) - 1)
+    nearest = np.where(np.abs(offline_index[right - 1] - online_index) <= np.abs(offline_index[right] - online_index),
+                       right - 1, right)
+    offset = online_index - offline_index[nearest]
+    matched = np.abs(offset) <= tolerance
+    report = {'offline_spikes': len(offline_index), 'online_spikes': len(online_index),
+              'exact_index': float(np.mean(offset == 0)), 'within_tolerance': float(np.mean(matched)),
+              'mean_offset': float(np.mean(offset[matched])),
+              # Shape difference of the causal windows, cut at each filter's own peak
+              'window_rms': float(np.sqrt(np.mean(np.square(online_windows[matched] -
+                                                            data_set.full_spikes[nearest[matched]])))),
+              'class_agreement': float(np.mean(online_classes[matched] == offline_classes[nearest[matched]])),
+              'latency_ms': sorter.latency_samples / 25000 * 1000}
+    print(report)
+    return report
+
+
+class SpikeCache:
+    # On-disk cache of filtered signals, peak indices and spike windows, addressed by source file and settings
+    version = 1
+    arrays = ['filtered_signal', 'neuron_index', 'full_spikes', 'duplicates', 'neuron_classes']
+
+    def __init__(self, path = 'cache'):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_hash(self, filename):
+        # Hash the file contents in blocks so large recordings are never fully in memory
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def key(self, filename, type, window, prom, filter_params, dtype = np.float64, align_params = None,
+            detection_version = None):
+        # Any change in the input file, processing settings or detection code version gives a new key
+        settings = {'version': self.version, 'file': self.file_hash(filename), 'type': type,
+                    'window': [int(w) for w in window], 'prom': prom, 'filter': filter_params,
+                    'dtype': np.dtype(dtype).name, 'align': align_params or {}, 'detection': detection_version}
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:20]
+
+    def load(self, key, data_set):
+        # Memory-map the cached arrays into the DataSet, returns False on a cache miss
+        entry = os.path.join(self.path, key)
+        if not os.path.exists(os.path.join(entry, 'meta.json')):
+            return False
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+        for name in meta['arrays']:
+            setattr(data_set, name, np.load(os.path.join(entry, name + '.npy'), mmap_mode='r'))
+        data_set.threshold = meta['threshold']
+        if data_set.diagnostics is not None:
+            # Only needed for the missing peaks plot
+            data_set.normalize_data()
+        print('Loaded ' + str(data_set.type) + ' spikes from cache ' + key)
+        return True
+
+    def save(self, key, data_set):
+        # Write into a temporary directory first so a partly written entry is never loaded
+        entry = os.path.join(self.path, key)
+        temp_entry = tempfile.mkdtemp(dir=self.path)
+        saved = []
+        for name in self.arrays:
+            if hasattr(data_set, name):
+                np.save(os.path.join(temp_entry, name + '.npy'), np.asarray(getattr(data_set, name)))
+                saved.append(name)
+        with open(os.path.join(temp_entry, 'meta.json'), 'w') as f:
+            json.dump({'arrays': saved, 'threshold': float(data_set.threshold)}, f)
+        if os.path.exists(entry):
+            shutil.rmtree(temp_entry)
+        else:
+            os.rename(temp_entry, entry)
 
 
 class logdata:
-    #Class used for logging data to a scv file
+    #Class used for logging data to a csv file
     filecount = 0
     # initiate path with file directory for saving csv
-    def __init__(self,path):
+    # columns is the header row, each write_row must give one value per column
+    # Rows are kept in memory and written in one append once max_rows are waiting or max_seconds have passed
+    def __init__(self, path, columns = None, max_rows = 1000, max_seconds = 10.0):
         self.PATH = path
         if not os.path.exists(path):
             os.makedirs(path)
         now_time = time.localtime()
         # Label file with time start to ensure uniqueness
         self.timestart = ("%02d_%02d_%02d_%02d_%02d_%02d" %(now_time[3],now_time[4],now_time[5],now_time[2],now_time[1],now_time[0]))
-        result_file = open(self.PATH + "\\Results_%s.txt" %(self.timestart), "w")
-        result_file.close()
+        self.filename = os.path.join(self.PATH, "Results_%s.csv" % (self.timestart))
+        self.columns = columns
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.pending = []
+        self.last_flush = time.time()
+        with open(self.filename, "w", newline='') as result_file:
+            if columns is not None:
+                csv.writer(result_file).writerow(columns)
+        # Rows still waiting are written when the programme exits
+        atexit.register(self.flush)
+
+    def write(self, input):
+        # Queue raw text for the file
+        self.pending.append(input)
+        if len(self.pending) >= self.max_rows or time.time() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def write_row(self, row):
+        # Queue one csv row, quoted by the csv module so values may contain commas
+        if self.columns is not None and len(row) != len(self.columns):
+            raise ValueError('Row has %s values but the file has %s columns' % (len(row), len(self.columns)))
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        self.write(line.getvalue())
+
+    def flush(self):
+        # Append every waiting row with a single open
+        if self.pending:
+            with open(self.filename, "a", newline='') as result_file:
+                result_file.write(''.join(self.pending))
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        # Write what is left and drop the exit handler, so repeated runs in one session do not pile them up
+        self.flush()
+        atexit.unregister(self.flush)
 
-    def write(self,input):
-        # Write data to .txt file
-        result_file = open(self.PATH + "\\Results_%s.txt" %(self.timestart), "a")
-        result_file.write(input)
-        result_file.close()
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
 
 class SimulatedAnnealing:
-    def __init__(self, first_params, iterations, alpha, training_spikes, training_classes, test_proportion = 0.7,demand = 1.0):
+    def __init__(self, first_params, iterations, alpha, training_spikes, training_classes, test_proportion = 0.7,demand = 1.0,
+                 proposals = 1, workers = None, features = None):
         #Assign inputs to self for easy access
         self.T = 1
         self.T_min = 0.001
@@ -360,29 +1793,60 @@ class SimulatedAnnealing:
         self.iterations = iterations
         self.alpha = alpha
         self.old_params = first_params
-        self.training_classes = training_classes
+        self.training_classes = np.asarray(training_classes)
         self.test_proportion = test_proportion
-        #use PCA to speed up process at the cost of performance
-        pca = PCA(n_components=0.99)
-        self.training_spikes = pca.fit_transform(training_spikes)
+        # Number of neighbour proposals evaluated together each iteration, in a process pool if more than one
+        self.proposals = proposals
+        self.workers = workers
+        #use PCA to speed up process at the cost of performance, unless an already fitted extractor is given
+        if features is None:
+            features = FeatureExtractor('pca', 0.99).fit(training_spikes)
+        self.training_spikes = features.transform(training_spikes)
+        # Memoised diff results, keyed on (k, p, split)
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
 
     def diff(self, params):
         # Input parameters into KNN model
         self.k = int(params[0])
         self.p = int(params[1])
+        # Only k and p are ever changed, so reuse any earlier result for the same model
+        key = (self.k, self.p, self.test_proportion)
+        if key in self.cache:
+            self.cache_hits += 1
+            return self.cache[key]
+        self.cache_misses += 1
         knn = KNearestNeighbor(self.training_spikes,self.training_classes, self.test_proportion)
         knn.create_model(self.k,self.p)
         knn.score()
         # Calculate the difference between results and target demand
         diff = self.demand - knn.accuracy
+        self.cache[key] = diff
         return  diff
 
+    def diff_batch(self, params_list, pool):
+        # Find the diff of several proposals, fitting the ones not already cached concurrently
+        keys = [(int(params[0]), int(params[1]), self.test_proportion) for params in params_list]
+        new_keys = []
+        for key in keys:
+            if key in self.cache or key in new_keys:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                new_keys.append(key)
+        for key, diff in zip(new_keys, pool.map(anneal_evaluate, new_keys)):
+            self.cache[key] = self.demand - diff
+        return [self.cache[key] for key in keys]
+
 
     def neighbour(self, params):
         # Change parameters to a neighboring value
         # Since only integers were allowed, te detla function was modified to select
         # a random integer instead of multiplying
+        # Work on a copy so the current parameters are kept if the proposal is rejected
+        params = np.array(params)
         delta = np.random.randint(3) - 1
         params[0] += delta
         params[1] = int(np.random.randint(1,4))
@@ -398,9 +1862,27 @@ class SimulatedAnnealing:
 
     def anneal(self):
         # Run the annealing loop
+        pool = None
+        shared = None
+        if self.proposals > 1:
+            # Share the spikes with the workers once, then evaluate proposals in parallel
+            shared = share_array(self.training_spikes)
+            pool = ProcessPoolExecutor(max_workers=self.workers, initializer=worker_init,
+                                       initargs=({'spikes': shared[1]}, {'labels': self.training_classes}))
+        try:
+            return self.anneal_loop(pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+                shared[0].close()
+                shared[0].unlink()
+
+    def anneal_loop(self, pool):
         # Reset old_diff
         self.old_diff = self.diff(self.old_params)
         self.diff_values = []
+        # Per iteration log of temperature, parameters, cache use and time taken
+        self.log = []
         #Append array to keep track of diff history
         self.diff_values.append(self.old_diff)
         # While loop for the cooling of T to below a threshold
@@ -408,9 +1890,19 @@ class SimulatedAnnealing:
             i = 1
             # Iterations between each cooling step
             while i <= self.iterations:
+                iteration_start = time.time()
+                hits, misses = self.cache_hits, self.cache_misses
                 # FInd new parameters amd corresponding diff
-                self.new_params = self.neighbour(self.old_params)
-                self.new_diff = self.diff(self.new_params)
+                if pool is None:
+                    self.new_params = self.neighbour(self.old_params)
+                    self.new_diff = self.diff(self.new_params)
+                else:
+                    # Take the best of a batch of proposals
+                    candidates = [self.neighbour(self.old_params) for n in range(self.proposals)]
+                    diffs = self.diff_batch(candidates, pool)
+                    best = int(np.argmin(diffs))
+                    self.new_params = candidates[best]
+                    self.new_diff = diffs[best]
                 # Calculate metropolis acceptance
                 ma = self.metropolis_acceptance()
                 # Check if metropolis acceptance applies
@@ -418,58 +1910,182 @@ class SimulatedAnnealing:
                     self.old_params = self.new_params
                     self.old_diff = self.new_diff
 
-                i =+ 1
-                #Print to monitor progress
-                print(self.T)
-                print(i)
-                print(self.old_params)
+                i += 1
+                #Log and print to monitor progress
+                self.log.append({'T': self.T, 'params': [int(x) for x in self.old_params], 'diff': self.old_diff,
+                                 'hits': self.cache_hits - hits, 'misses': self.cache_misses - misses,
+                                 'elapsed': time.time() - iteration_start})
+                print(self.log[-1])
                 # Append diff to log history
                 self.diff_values.append(self.old_diff)
             #Cool temperature before next loop
 
             self.T = self.T * self.alpha
         print(self.diff_values)
+        print('Cache hits: ' + str(self.cache_hits) + ', misses: ' + str(self.cache_misses))
         return self.old_params
 
-def knn_grid_selection(max_k,max_p):
-    # Run grid selection loop for KNN
-    # Create lists of parameter combinations
-    k_list = np.arange(1,max_k+1)
-    p_list = np.arange(1,max_p+1)
+#Arrays shared with worker processes, filled once per worker by worker_init
+grid_data = {}
+
+def share_array(array):
+    # Copy an array into shared memory so worker processes can view it without it being pickled
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    # Open a read-only view of an array created by share_array
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
+
+def worker_init(specs, extras):
+    # Runs once in each worker, attach to the shared spike matrices and keep the small extras alongside
+    for key, spec in specs.items():
+        shm, array = attach_array(spec)
+        # Keep the handle so the buffer stays mapped
+        grid_data[key + '_shm'] = shm
+        grid_data[key] = array
+    grid_data.update(extras)
+
+def anneal_evaluate(key):
+    # Fit and score one SimulatedAnnealing proposal in a worker, returns the accuracy
+    k, p, split = key
+    knn = KNearestNeighbor(grid_data['spikes'], grid_data['labels'], split)
+    knn.create_model(k, p)
+    knn.score()
+    return knn.accuracy
+
+def neighbour_votes(neighbour_labels, classes):
+    # Majority class among the first k neighbours for every k at once, shape (N, max_k)
+    # Ties go to the lowest class, as in KNeighborsClassifier
+    votes = np.cumsum(neighbour_labels[:, :, None] == classes[None, None, :], axis=1, dtype=np.int32)
+    return classes[np.argmax(votes, axis=2)]
+
+def grid_evaluate_p(p, max_k):
+    # Score every k for one distance p from a single neighbour index and query at max k
+    train_labels = grid_data['train_labels']
+    classes = np.unique(train_labels)
+    index = NearestNeighbors(n_neighbors=max_k, p=p).fit(grid_data['train_spikes'])
+    test_votes = neighbour_votes(train_labels[index.kneighbors(grid_data['test_spikes'], return_distance=False)], classes)
+    sub_votes = neighbour_votes(train_labels[index.kneighbors(grid_data['sub_spikes'], return_distance=False)], classes)
+    rows = []
+    for k in range(1, max_k + 1):
+        accuracy = metrics.accuracy_score(grid_data['test_labels'], test_votes[:, k - 1])
+        # Standard deviation of output class totals on the submission data
+        unique, counts = np.unique(sub_votes[:, k - 1], return_counts=True)
+        rows.append((k, p, accuracy, np.std(counts)))
+    return rows
+
+def knn_grid_selection(max_k, max_p, training_set, submission_set, train_proportion = 0.98, workers = None,
+                       results_path = os.path.join('Results', 'CourseworkC'), features = None):
+    # Run grid selection for KNN, one worker process per distance p
     # Create empty array to input results into for accuracy and standard deviation
     result_accuracy = np.zeros((max_k+1,max_p+1))
     result_std = np.zeros((max_k+1,max_p+1))
     # Create results file to save to csv
-    results_file_headers = 'k, p, accuracy, standard deviation'
-    resultsfile = logdata('C:\PythonProject\CompInt\CourseworkC')
-    resultsfile.write(results_file_headers)
-    # Run through all combinations
-    for k in k_list:
-        for p in p_list:
-            # Apply parameters to KNN model
-            knn = KNearestNeighbor(np.array(training_set.full_spikes), training_set.neuron_classes, 0.98)
-            knn.create_model(k, p)
-            knn.score()
-            # log accuracy results
-            result_accuracy[k][p] = knn.accuracy
-            # Apply to submission data to find standard deviation of output class totals
-            submission_classes = knn.predict(submission_set)
-            submission_index = submission_set.neuron_index
-            # Zipp results into dictionary
-            unique, counts = np.unique(submission_classes, return_counts=True)
-            print('Submission Class counts: ')
-            print(dict(zip(unique, counts)))
-            result_std[k][p] = np.std(counts)
-            print('std: ' + str(result_std[k][p]))
-            #Write results to csv file
-            resultsfile.write('\n' + str(k) + ', ' + str(p) + ', ' + str(knn.accuracy) + ', ' + str(np.std(counts)))
+    resultsfile = logdata(results_path, ['k', 'p', 'accuracy', 'standard deviation'])
+    # Split as KNearestNeighbor does
+    spikes = np.asarray(training_set.full_spikes)
+    labels = np.asarray(training_set.neuron_classes)
+    submission_spikes = np.asarray(submission_set.full_spikes)
+    if features is not None:
+        # Search in the reduced feature space
+        spikes = features.transform(spikes)
+        submission_spikes = features.transform(submission_spikes)
+    split = int(len(spikes)*train_proportion)
+    # Place the spike matrices in shared memory once, workers attach instead of receiving copies per task
+    shared = {'train_spikes': share_array(spikes[:split]), 'test_spikes': share_array(spikes[split:]),
+              'sub_spikes': share_array(submission_spikes)}
+    specs = {key: spec for key, (shm, spec) in shared.items()}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=worker_init,
+                                 initargs=(specs, {'train_labels': labels[:split], 'test_labels': labels[split:]})) as pool:
+            futures = [pool.submit(grid_evaluate_p, p, max_k) for p in range(1, max_p+1)]
+            # Write results to csv file as each p finishes
+            for future in as_completed(futures):
+                for k, p, accuracy, std in future.result():
+                    result_accuracy[k][p] = accuracy
+                    result_std[k][p] = std
+                    print('k=%s, p=%s, accuracy: %s, std: %s' % (k, p, accuracy, std))
+                    resultsfile.write_row([k, p, accuracy, std])
+    finally:
+        resultsfile.close()
+        for shm, spec in shared.values():
+            shm.close()
+            shm.unlink()
     # mean is always the same once peaks are found
+    # Return the most accurate parameters
+    best_k, best_p = np.unravel_index(np.argmax(result_accuracy), result_accuracy.shape)
+    return [int(best_k), int(best_p)]
+
+
+def build_classifier(classifier, params, spikes, labels):
+    # Create and fit either classifier from a parameter dictionary
+    if classifier == 'knn':
+        model = KNearestNeighbor(spikes, labels, 1.0)
+        model.create_model(params.get('k', 4), params.get('p', 2))
+    if classifier == 'nn':
+        # Train in the precision of the spikes
+        model = NeuralNetwork(spikes.shape[1], params.get('hidden_nodes', 1000), 5, params.get('learning_rate', 0.05),
+                              spikes.dtype.type)
+        model.fit(spikes, labels, params.get('iterations', 50), params.get('batch_size', 32))
+    return model
+
+def fold_evaluate(classifier, params, train_idx, test_idx, classes):
+    # Fit and score one cross-validation fold in a worker, using the shared spike matrix
+    spikes = grid_data['spikes']
+    labels = grid_data['labels']
+    fit_start = time.time()
+    model = build_classifier(classifier, params, spikes[train_idx], labels[train_idx])
+    fit_time = time.time() - fit_start
+    predict_start = time.time()
+    prediction = model.classify(spikes[test_idx])
+    predict_time = time.time() - predict_start
+    return {'accuracy': metrics.accuracy_score(labels[test_idx], prediction),
+            'fit_time': fit_time, 'predict_time': predict_time,
+            'confusion_matrix': metrics.confusion_matrix(labels[test_idx], prediction, labels=classes)}
+
+def cross_validate(classifier, params, spikes, labels, folds = 5, workers = None, seed = 0):
+    # Stratified k-fold evaluation of 'knn' or 'nn', with folds run in parallel
+    spikes = np.asarray(spikes)
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    # Share the spike matrix once rather than sending a copy with every fold
+    shm, spec = share_array(spikes)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=worker_init,
+                                 initargs=({'spikes': spec}, {'labels': labels})) as pool:
+            futures = [pool.submit(fold_evaluate, classifier, params, train_idx, test_idx, classes)
+                       for train_idx, test_idx in splitter.split(spikes, labels)]
+            results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    accuracies = np.array([result['accuracy'] for result in results])
+    report = {'classifier': classifier, 'params': params, 'folds': results,
+              'mean_accuracy': accuracies.mean(), 'std_accuracy': accuracies.std(),
+              'confusion_matrix': sum(result['confusion_matrix'] for result in results)}
+    # print to console for viewing
+    for n, result in enumerate(results):
+        print('Fold %s: accuracy %.4f, fit %.3fs, predict %.3fs' % (n + 1, result['accuracy'], result['fit_time'],
+                                                                   result['predict_time']))
+    print('Accuracy: %.4f +/- %.4f' % (report['mean_accuracy'], report['std_accuracy']))
+    print(report['confusion_matrix'])
+    return report
 
 
 #------------User Inputs-----------#
 #Simulated annealing params
 alpha = 0.1
 iterations = 10
+sa_proposals = 1
 first_params = [np.random.randint(1,20), np.random.randint(1,3)]
 first_params = np.array(first_params)
 #Neural Network params
@@ -477,79 +2093,216 @@ hidden_nodes = 1000
 learning_rate = 0.05
 training_iterations = 50
 training_proportion = 0.9
+batch_size = 32
+#Stop once validation accuracy has not improved for this many epochs, None to always run training_iterations
+nn_patience = 5
+#Multiply the learning rate by this after every epoch
+nn_lr_decay = 1.0
+#Save weights here after every epoch and resume from it if present, None to skip
+nn_checkpoint = None
 #------------Constants-------------#
 sampling_rate = 25000
 spike_window = [14,35]
+#Minimum peak prominence for detection, the submission recording is noisier
+training_prom = 0.2
+submission_prom = 0.25
+#Filter settings for DataSet.apply_filters, e.g. {'fc_high': 2000}, defaults when empty
+filter_params = {}
 #Function Selection Flags
 #Choose only one Machine learning Method
 use_NN = False
 use_KNN = True
+#Evaluate the chosen method with stratified k-fold cross-validation
+use_cross_validation = False
+cv_folds = 5
+#KNN neighbour search: 'auto', 'brute', 'kd_tree', 'ball_tree' or approximate 'rp_forest'
+knn_backend = 'auto'
+knn_leaf_size = 30
+#Print recall and latency of each neighbour backend and leaf size against exact search,
+#then use the fastest leaf size for knn_backend
+benchmark_backends = False
+knn_leaf_sizes = (10, 30, 100)
 #Optimisation method for KNN
 use_SA = False
 use_grid_selection = False #Best was accuracy found to be k = 2, p =3, best std was k=3,p=4
 #Use Submission data
 create_sub = True
+#Process the submission in chunks of this many samples instead of all at once
+use_streaming = False
+stream_chunk_size = 250000
+#Simulate live acquisition by feeding the submission to the online sorter in blocks of this many samples
+use_online = False
+online_block_size = 250
 #Show Plots
 show_plots = False
+#Load recordings as memory-mapped .npy files, converted from .mat on first use
+use_memmap = True
+#Storage type of the converted signal, np.float32 halves memory
+signal_dtype = np.float64
+#Precision for filtering, spike windows and the NN, np.float32 halves memory traffic
+compute_dtype = np.float64
+#Compare the float32 pipeline against float64 on the training data
+check_precision = False
+#Align spike windows to the upsampled 'peak' or 'trough' near each detection, None to cut at the raw peak
+align_spikes = None
+#Detections closer than this many samples keep only the largest, None to keep all
+refractory_period = 30
+#Cache filtered signals and spike windows between runs
+use_cache = True
+cache_path = 'cache'
+#Reduce spike windows to features before classifying: None, 'pca', 'wavelet' or 'template'
+feature_method = None
+feature_components = 0.99
+feature_path = 'features.npz'
+#Save the trained model and its preprocessing settings here for classify.py, None to skip
+model_path = None
+#Print the speed and accuracy of each feature method against raw windows
+compare_features = False
+#Log the time and memory of each pipeline stage to this JSON-lines file, None to disable
+profile_log = None
+#Trace peak memory of each stage, slows allocation-heavy stages
+profile_memory = False
+#Keep a cProfile dump of each stage in this folder, None to skip
+profile_dir = None
 
 
 
 if __name__ == '__main__':
 
+    if profile_log is not None:
+        profiler.configure(profile_log, profile_memory, profile_dir)
     #-----Import spike data, class and indices
-    training_table = spio.loadmat('training.mat', squeeze_me=True)
+    if use_memmap:
+        training_table = load_recording('training.mat', signal_dtype)
+        submission_data = load_recording('submission.mat', signal_dtype)['d']
+    else:
+        training_table = spio.loadmat('training.mat', squeeze_me=True)
+        submission_data = spio.loadmat('submission.mat', squeeze_me=True)['d']
     training_data = training_table['d']
     training_class = training_table['Class']
     training_index = training_table['Index']
-    submission_data = spio.loadmat('submission.mat', squeeze_me=True)['d']
     unique, counts = np.unique(training_class, return_counts=True)
     print('Training Class counts: ')
     print(dict(zip(unique, counts)))
+    if check_precision:
+        precision_parity(training_data, training_class, training_index, spike_window, training_prom)
     #-----Data handling
+    align_params = {'align': align_spikes, 'refractory': refractory_period}
+    # Reuse filtered signals and spike windows from earlier runs with the same settings
+    cache = SpikeCache(cache_path) if use_cache else None
     #Instatiate DataSet class
-    training_set = DataSet(training_data, training_class, training_index, type = 'training')
+    training_set = DataSet(training_data, training_class, training_index, type = 'training', plot = show_plots,
+                           dtype = compute_dtype)
     #Put training spikes in order
     training_set.sort_spikes()
     #Use butter and savgol filter to reduce signal noise
-    training_set.filter_signal()
-    training_set.detect_spikes(spike_window,0.2)
+    training_set.process(spike_window, training_prom, cache, 'training.mat', align_params, **filter_params)
     training_set.analyse_detected_peaks()
+    #-----Feature extraction
+    if compare_features:
+        feature_tradeoff(training_set.full_spikes, training_set.neuron_classes,
+                         [FeatureExtractor('pca', feature_components), FeatureExtractor('wavelet', feature_components),
+                          FeatureExtractor('template')])
+    features = None
+    training_spikes = training_set.full_spikes
+    if feature_method is not None:
+        # Fit once and reuse the stored extractor on later runs with the same settings and training spikes
+        features = FeatureExtractor(feature_method, feature_components)
+        key = features.fit_key(training_set.full_spikes, training_set.neuron_classes)
+        stored = FeatureExtractor().load(feature_path) if os.path.exists(feature_path) else None
+        if stored is not None and stored.key == key:
+            features = stored
+        else:
+            features.fit(training_set.full_spikes, training_set.neuron_classes)
+            features.save(feature_path)
+        training_spikes = features.transform(training_set.full_spikes)
 
     if use_SA:
         #Begin simulated annealing process for KNN
-        sa = SimulatedAnnealing(first_params,iterations,alpha,training_set.full_spikes,training_set.neuron_classes)
+        sa = SimulatedAnnealing(first_params,iterations,alpha,training_set.full_spikes,training_set.neuron_classes,
+                                proposals = sa_proposals, features = features)
         best_params = sa.anneal()
         print(best_params)
     if use_grid_selection:
         #Begin grid selection for KNN
-        submission_set = DataSet(submission_data, type='submission')
-        submission_set.filter_signal()
-        submission_set.detect_spikes(spike_window, 0.25)
-        best_params = knn_grid_selection(20,5)
+        submission_set = DataSet(submission_data, type='submission', plot = show_plots, dtype = compute_dtype)
+        submission_set.process(spike_window, submission_prom, cache, 'submission.mat', align_params,
+                               **filter_params)
+        best_params = knn_grid_selection(20, 5, training_set, submission_set, features = features)
         print(best_params)
 
+    if use_cross_validation:
+        # Run fold-parallel evaluation of the chosen method
+        if use_NN:
+            cross_validate('nn', {'hidden_nodes': hidden_nodes, 'learning_rate': learning_rate,
+                                  'iterations': training_iterations, 'batch_size': batch_size},
+                           training_spikes, training_set.neuron_classes, cv_folds)
+        if use_KNN:
+            cross_validate('knn', {'k': 4, 'p': 2}, training_spikes, training_set.neuron_classes, cv_folds)
+
     if use_NN:
         #Run NN code
-        nn = NeuralNetwork(len(training_set.full_spikes[0]), hidden_nodes, 5, learning_rate)
-        nn.run(training_set.full_spikes, training_set.neuron_classes, training_iterations, training_proportion)
+        nn = NeuralNetwork(len(training_spikes[0]), hidden_nodes, 5, learning_rate, compute_dtype)
+        nn.run(training_spikes, training_set.neuron_classes, training_iterations, training_proportion, batch_size,
+               patience = nn_patience, lr_decay = nn_lr_decay, checkpoint = nn_checkpoint)
 
     if use_KNN:
         # Run KNN code
-        knn = KNearestNeighbor(np.array(training_set.full_spikes), training_set.neuron_classes, 0.90)
-        knn.create_model(4, 2)
+        knn = KNearestNeighbor(np.array(training_spikes), training_set.neuron_classes, 0.90)
+        if benchmark_backends:
+            results = neighbour_benchmark(training_spikes, training_set.neuron_classes, 4, 2,
+                                          leaf_sizes = knn_leaf_sizes)
+            # Use the fastest leaf size that keeps the chosen backend's recall
+            knn_leaf_size = tuned_leaf_size(results, knn_backend, knn_leaf_size)
+        knn.create_model(4, 2, knn_backend, knn_leaf_size)
         knn.score()
         print('Accuracy:' + f'{(knn.accuracy):.3%}')
 
     if create_sub:
         #Create submission dataset file
-        submission_set = DataSet(submission_data, type='submission')
-        submission_set.filter_signal()
-        submission_set.detect_spikes(spike_window, 0.25)
-        if use_NN:
-            submission_classes = nn.predict(submission_set.full_spikes)
-        if use_KNN:
-            submission_classes = knn.predict(submission_set)
-        submission_index = submission_set.neuron_index
+        submission_set = DataSet(submission_data, type='submission', plot = show_plots, dtype = compute_dtype)
+        if use_online:
+            # Classify spikes causally as each block of samples arrives
+            # Normalise with the training maximum, a live stream has no maximum of its own
+            online_scale = float(np.max(training_set.filtered_signal))
+            if use_NN:
+                sorter = OnlineSpikeSorter(nn, spike_window, submission_prom, online_scale, features = features,
+                                           **align_params)
+            if use_KNN:
+                sorter = OnlineSpikeSorter(knn, spike_window, submission_prom, online_scale, features = features,
+                                           **align_params)
+            submission_index = []
+            submission_classes = []
+            for start in range(0, len(submission_data), online_block_size):
+                for index, neuron_class in sorter.process(submission_data[start:start + online_block_size]):
+                    submission_index.append(index)
+                    submission_classes.append(neuron_class)
+            print('Online latency: ' + str(sorter.latency_samples / sampling_rate * 1000) + 'ms + block length')
+        elif use_streaming:
+            # Filter, detect and classify the submission one chunk at a time
+            submission_index = []
+            submission_classes = []
+            streamed = submission_set.stream_spikes(spike_window, submission_prom, stream_chunk_size, **align_params,
+                                                    **filter_params)
+            for peak_indices, spike_windows in streamed:
+                if features is not None:
+                    spike_windows = features.transform(spike_windows)
+                if use_NN:
+                    submission_classes.extend(nn.predict(spike_windows))
+                if use_KNN:
+                    submission_classes.extend(knn.classify(spike_windows))
+                submission_index.extend(peak_indices)
+        else:
+            submission_set.process(spike_window, submission_prom, cache, 'submission.mat', align_params,
+                                   **filter_params)
+            submission_spikes = submission_set.full_spikes
+            if features is not None:
+                submission_spikes = features.transform(submission_spikes)
+            if use_NN:
+                submission_classes = nn.predict(submission_spikes)
+            if use_KNN:
+                submission_classes = knn.classify(submission_spikes)
+            submission_index = submission_set.neuron_index
         unique, counts = np.unique(submission_classes, return_counts=True)
         print('Submission Class counts: ')
         print(dict(zip(unique, counts)))
@@ -558,5 +2311,17 @@ if __name__ == '__main__':
         print('Class mean:' + str(class_mean))
         print('Class std:' + str(class_std))
         #spio.savemat('13818.mat', mdict={'Index': np.array(submission_index), 'Class': np.array(submission_classes)})
+    if model_path is not None:
+        # Save the trained model so new recordings can be classified without retraining
+        if use_NN:
+            save_model(model_path, nn, spike_window, submission_prom, filter_params = filter_params, features = features,
+                       dtype = compute_dtype, align_params = align_params)
+        if use_KNN:
+            save_model(model_path, knn, spike_window, submission_prom, filter_params = filter_params, features = features,
+                       dtype = compute_dtype, align_params = align_params)
     if show_plots:
+        # Draw the recorded diagnostics only now they are going to be shown
+        training_set.diagnostics.render()
+        if create_sub:
+            submission_set.diagnostics.render()
         plt.show()
@@ -0,0 +1,12 @@
+import sys
+from Main import classify_batch
+
+# Label the spikes in many recordings using a model saved by Main.py (set model_path there)
+# Usage: python batch_classify.py model.npz <directory or glob> output_directory [workers]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: python batch_classify.py model.npz <directory or glob> output_directory [workers]')
+        sys.exit(1)
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    classify_batch(sys.argv[2], sys.argv[1], sys.argv[3], workers)
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import scipy
+import scipy.io as spio
+import sklearn
+from sklearn import metrics
+from Main import DataSet, KNearestNeighbor, NeuralNetwork, profiler, spike_window, sampling_rate
+
+# Benchmark suite for the spike pipeline on synthetic recordings with known spike times and classes
+# Usage: python benchmark.py [--minutes 1 10 30 120] [--output benchmark.json]
+# Each stage is timed separately and the results are written as JSON so runs can be compared between versions
+
+
+def synthetic_recording(minutes, rate = 40, seed = 0):
+    # Noisy 25kHz recording with spikes of 5 shapes, returns the signal, classes and spike start indices
+    random = np.random.default_rng(seed)
+    n_samples = int(minutes * 60 * sampling_rate)
+    t = np.arange(n_samples)
+    signal = random.normal(0, 0.1, n_samples) + 0.5*np.sin(2*np.pi*0.5*t/sampling_rate)
+    # Spike starts with at least 60 samples between them, as in the training recordings
+    n_spikes = int(minutes * 60 * rate)
+    gaps = 60 + random.exponential(sampling_rate / rate - 60, n_spikes).astype(int)
+    index = 100 + np.cumsum(gaps)
+    index = index[index < n_samples - 100]
+    classes = random.integers(1, 6, len(index))
+    # One template per class, differing in peak height, width and after-hyperpolarisation
+    x = np.arange(40)
+    templates = np.array([(1 + c)*np.exp(-((x - 8 - c)/(1.5 + 0.3*c))**2) - 0.5*c*np.exp(-((x - 20)/5)**2)
+                          for c in range(1, 6)])
+    np.add.at(signal, index[:, None] + x, templates[classes - 1])
+    return signal, classes, index
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    # Run one stage and record its wall time
+    stage_start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = time.perf_counter() - stage_start
+    return result
+
+
+def benchmark_scale(minutes, directory, k = 4, p = 2, hidden_nodes = 100, iterations = 20, batch_size = 32):
+    # Time every stage of the training pipeline on one synthetic recording
+    # iterations is enough epochs for nn_accuracy to reflect the trained network
+    signal, classes, index = synthetic_recording(minutes)
+    filename = os.path.join(directory, 'benchmark_%smin.mat' % minutes)
+    spio.savemat(filename, {'d': signal, 'Class': classes, 'Index': index})
+    del signal
+    if profiler.path is None:
+        # detect_spikes reports its sub-stages through the profiler, which only records them once configured
+        profiler.configure(os.path.join(directory, 'profile.jsonl'))
+    timings = {}
+    table = timed(timings, 'load', spio.loadmat, filename, squeeze_me=True)
+    data_set = DataSet(table['d'], table['Class'], table['Index'], type = 'training', plot = False)
+    data_set.sort_spikes()
+    timed(timings, 'filter', data_set.filter_signal)
+    data_set.detect_spikes(spike_window, 0.2)
+    # detect_spikes records its detect, associate and window steps as profiler stages
+    timings.update({stage: profiler.last[stage]['seconds'] for stage in ('detect', 'associate', 'window')})
+    knn = KNearestNeighbor(data_set.full_spikes, data_set.neuron_classes, 0.9)
+    timed(timings, 'knn_fit', knn.create_model, k, p)
+    knn_prediction = timed(timings, 'knn_predict', knn.classify, knn.test_spikes)
+    nn = NeuralNetwork(len(data_set.full_spikes[0]), hidden_nodes, 5, 0.05)
+    split = int(len(data_set.full_spikes)*0.9)
+    timed(timings, 'nn_fit', nn.fit, data_set.full_spikes[:split], data_set.neuron_classes[:split], iterations,
+          batch_size)
+    nn_prediction = timed(timings, 'nn_predict', nn.classify, data_set.full_spikes[split:])
+    os.remove(filename)
+    return {'minutes': minutes, 'samples': len(table['d']), 'true_spikes': len(index),
+            'detected_spikes': len(data_set.full_spikes), 'timings': timings,
+            'knn_accuracy': metrics.accuracy_score(knn.test_labels, knn_prediction),
+            'nn_accuracy': metrics.accuracy_score(data_set.neuron_classes[split:], nn_prediction)}
+
+
+def code_version():
+    # Commit the benchmark was run on, if this is a git checkout
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the spike pipeline on synthetic recordings')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10, 30, 120],
+                        help='recording lengths to benchmark, in minutes')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    args = parser.parse_args()
+    results = {'version': code_version(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'scipy': scipy.__version__, 'sklearn': sklearn.__version__, 'machine': platform.machine(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scales': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for minutes in args.minutes:
+            print('Benchmarking %s minute recording' % minutes)
+            results['scales'].append(benchmark_scale(minutes, directory))
+            print(json.dumps(results['scales'][-1]['timings'], indent=2))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to ' + args.output)
@@ -0,0 +1,17 @@
+import sys
+import numpy as np
+from Main import classify
+
+# Label the spikes in one recording using a model saved by Main.py (set model_path there)
+# Usage: python classify.py model.npz recording.mat [output.mat]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python classify.py model.npz recording.mat [output.mat]')
+        sys.exit(1)
+    output = sys.argv[3] if len(sys.argv) > 3 else None
+    index, classes = classify(sys.argv[2], sys.argv[1], output)
+    unique, counts = np.unique(classes, return_counts=True)
+    print('Spikes classified: ' + str(len(classes)))
+    print('Class counts: ')
+    print(dict(zip(unique, counts)))
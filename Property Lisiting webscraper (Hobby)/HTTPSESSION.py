@@ -0,0 +1,35 @@
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+class SESSION:
+
+    # One requests.Session shared by every fetch, so connections and TLS sessions are kept alive and reused
+    # pool_size is the number of open connections kept per host and the number of requests in flight at once
+    # timeout is (connect, read) seconds
+    def __init__(self,headers,pool_size=10,timeout=(5, 30),hosts=4):
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        # Ask for compressed pages, requests decompresses them
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.headers['Connection'] = 'keep-alive'
+        # Retries are handled by the crawler, pool_block waits for a free connection instead of opening extras
+        adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = timeout
+        # One thread per pooled connection, so asyncio can wait on every request at once
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def GET(self,url):
+        return self.session.get(url, timeout=self.timeout)
+
+    async def AGET(self,url):
+        # GET without blocking the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.GET, url)
+
+    def CLOSE(self):
+        self.executor.shutdown()
+        self.session.close()
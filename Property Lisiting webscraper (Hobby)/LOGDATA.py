@@ -1,23 +1,62 @@
 import sys
 import os
 import time
+import atexit
+import csv
+import io
 
 class DATA:
 
     filecount = 0
 
-    def __init__(self,path):
+    # columns is the header row, each WRITE_ROW must give one value per column
+    # Rows are kept in memory and written in one append once max_rows are waiting or max_seconds have passed
+    def __init__(self,path,columns=None,max_rows=100,max_seconds=10.0):
         self.PATH = path
         if not os.path.exists(path):
             os.makedirs(path)
         now_time = time.localtime()
         self.timestart = ("%02d_%02d_%02d_%02d_%02d_%02d" %(now_time[3],now_time[4],now_time[5],now_time[2],now_time[1],now_time[0]))
-        result_file = open(self.PATH + "\\Results_%s.txt" %(self.timestart), "w")
-        result_file.close()
+        self.FILENAME = os.path.join(self.PATH, "Results_%s.csv" %(self.timestart))
+        self.columns = columns
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.pending = []
+        self.last_flush = time.time()
+        with open(self.FILENAME, "w", newline='') as result_file:
+            if columns is not None:
+                csv.writer(result_file).writerow(columns)
+        # Rows still waiting are written when the script exits
+        atexit.register(self.FLUSH)
 
     def WRITE(self,input):
-        result_file = open(self.PATH + "\\Results_%s.txt" %(self.timestart), "a")
-        result_file.write(input)
-        result_file.close()
+        self.pending.append(input)
+        if len(self.pending) >= self.max_rows or time.time() - self.last_flush >= self.max_seconds:
+            self.FLUSH()
 
+    def WRITE_ROW(self,row):
+        # csv quoting keeps commas inside values from splitting the column
+        if self.columns is not None and len(row) != len(self.columns):
+            raise ValueError('Row has %s values but the file has %s columns' %(len(row), len(self.columns)))
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        self.WRITE(line.getvalue())
 
+    def FLUSH(self):
+        # Append every waiting row with a single open
+        if self.pending:
+            with open(self.FILENAME, "a", newline='') as result_file:
+                result_file.write(''.join(self.pending))
+            self.pending = []
+        self.last_flush = time.time()
+
+    def CLOSE(self):
+        # Write what is left and drop the exit handler
+        self.FLUSH()
+        atexit.unregister(self.FLUSH)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.CLOSE()
@@ -1,128 +1,225 @@
 import LOGDATA
+import HTTPSESSION
 from bs4 import BeautifulSoup
-from requests import get
+import requests
 import pandas as pd
 import itertools
 import seaborn as sns
-resultsfileheaders = 'Macro, Micro, Description, Price, Type, Area Sqft, Bedrooms, When Listed, Listed by, Listing comment, Link, comment'
-resultsfile = LOGDATA.DATA('C:\PythonProject\CompInt')
-resultsfile.WRITE(resultsfileheaders)
+import os
+import asyncio
+import time
+from urllib.parse import urlparse
+resultsfileheaders = ['Macro', 'Micro', 'Description', 'Price', 'Type', 'Area Sqft', 'Bedrooms', 'When Listed', 'Listed by', 'Listing comment', 'Link', 'comment']
+resultsfile = LOGDATA.DATA(os.path.join('Results', 'CompInt'), resultsfileheaders)
 total_skips = 0
 total_pages = 9999
 n = 1
 choosepage=1
+#Crawler settings
+#Listing pages fetched at the same time
+concurrency = 8
+#Politeness limit, requests per second started against the same host, with bursts of up to host_burst
+#Up to concurrency requests can be in flight at once within this rate
+host_rate = 4.0
+host_burst = concurrency
+#Attempts after a failed request, waiting backoff, 2*backoff, 4*backoff... seconds between them
+retries = 3
+backoff = 2.0
+#Connections kept open to the site, one per worker plus one for the search pages
+pool_size = concurrency + 1
+#Seconds to wait for a connection and for a response
+timeout = (5, 30)
 links = [["https://www.propertyfinder.ae/en/search?c=2&l=1863&ob=mr&page=1&rp=y&t=1","Rent"],
          ["","BUY"],
 ["","BUY"],
 ["","ResiRENT"]
 ]
+sns.set()
+headers = ({'User-Agent':
+            'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36'})
+session = HTTPSESSION.SESSION(headers, pool_size, timeout)
+#Status codes worth retrying, the server is busy or briefly down
+retry_status = (429, 500, 502, 503, 504)
 
-for link in links:
-    for n in range(total_pages):
-        n += (choosepage-1)
-        n += 1
-        print(n)
-        comment = link[1]
-        print(comment)
-        new_link = link[0].replace('page=1','page=%s'%(n))
-        print(new_link)
-        propertyfinder = new_link
-        sns.set()
-        headers = ({'User-Agent':
-                    'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36'})
-        response = get(propertyfinder, headers=headers)
-        html_soup = BeautifulSoup(response.text, 'html.parser')
-        house_containers = html_soup.find_all('div', class_="card-list__item")
-        listings_on_page = len(house_containers)
-        a = 0
-        #print(house_containers[2])
-        for a in range(listings_on_page):
-            #print(a)
-            first = house_containers[a]
+def fix_price(price):
+    price=price.replace('     ','')
+    price=price.replace('\n','')
+    price=price.replace('   ','')
+    price=price.replace(',','')
+    price=price.replace('AED/year','')
+    return price
+
+class HOSTLIMIT:
+    # Token bucket per host, refilled at rate tokens per second up to burst, one token per request started
+    def __init__(self,rate,burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.locks = {}
+
+    async def WAIT(self,url):
+        host = urlparse(url).netloc
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        # The lock is only held while waiting for a token, the request itself runs alongside the others
+        async with lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+                tokens = 1
+                now = time.monotonic()
+            self.buckets[host] = (tokens - 1, now)
+
+async def fetch(url, limiter):
+    # Get a page without blocking the other requests, retrying with exponential backoff on transient failures
+    for attempt in range(retries + 1):
+        await limiter.WAIT(url)
+        try:
+            response = await session.AGET(url)
+            if response.status_code not in retry_status:
+                response.raise_for_status()
+                return response.text
+            error = requests.HTTPError('%s for %s' %(response.status_code, url))
+            # Honour the server's own wait if it sends one
+            wait = response.headers.get('Retry-After')
+            wait = float(wait) if wait is not None and wait.isdigit() else backoff * 2**attempt
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            wait = backoff * 2**attempt
+        if attempt == retries:
+            raise error
+        print('Retrying %s in %.1fs: %s' %(url, wait, error))
+        await asyncio.sleep(wait)
+
+def parse_search_page(html, n, comment):
+    # Fields shown on the search results cards, one dict per listing
+    html_soup = BeautifulSoup(html, 'html.parser')
+    house_containers = html_soup.find_all('div', class_="card-list__item")
+    types = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--property-type")
+    areas = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--area")
+    bedroom_list = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--bedrooms")
+    titles = html_soup.find_all('h2', class_="card__title card__title-link")
+    listings = []
+    for a in range(len(house_containers)):
+        first = house_containers[a]
+        try:
             #Type
-            type = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--property-type")[a].text
-            #Location
-            location = first.find_all('span')[3].text
-            location = location.replace(',','-')
+            type = types[a].text
             #Area
             try:
-                area_str = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--area")[a].text
+                area_str = areas[a].text
             except:
                 area_str = 'VOID'
             area_str = area_str.replace(',','')
             area_str = area_str.replace('sqft', '')
             #Bedrooms
             try:
-                bedrooms = html_soup.find_all('p', class_="card__property-amenity card__property-amenity--bedrooms")[a].text
+                bedrooms = bedroom_list[a].text
             except:
                 bedrooms = 'VOID'
-
             #Title
-            title = html_soup.find_all('h2', class_="card__title card__title-link")[a].text
+            title = titles[a].text
             title = title.replace(',','-')
             if title.isalnum() != False:
                 title = 'VOID'
             #Price
-            price_str = first.find_all('span')[0].text
-
-            def fix_price(price):
-                price=price.replace('     ','')
-                price=price.replace('\n','')
-                price=price.replace('   ','')
-                price=price.replace(',','')
-                price=price.replace('AED/year','')
-                return price
-            price_str = fix_price(price_str)
-            print(price_str)
+            price_str = fix_price(first.find_all('span')[0].text)
             try:
                 price_float = int(''.join(itertools.takewhile(str.isdigit, price_str )))
             except:
                 price_float = '0'
-            print(price_str)
-
             #url
             url = 'https://www.propertyfinder.ae/' + first.find_all('a')[0].get('href')
-            response2 = get(url, headers=headers)
-            html_soup2 = BeautifulSoup(response2.text, 'html.parser')
-            #Description
-            desc_container = html_soup2.find_all('div', class_="panel panel--style1 panel--style3")
-            first = desc_container[0]
-            description = first.find_all('h2')[0].text
-            description = description.replace('        ','')
-            description = description.replace(', ','-')
-            description = description.replace('\n','')
-            #print(description)
-            #Listed
-            listing_box = html_soup2.find_all('div', class_="property-page__legal-list-item property-page__legal-list-item--value")
-            listed = listing_box[1].text
-            #Lister
-            listing_box = html_soup2.find_all('div', class_="text text--size2 property-agent__position")
-            lister = listing_box[0].text
-            #Micro
-            location_box1 = html_soup2.find_all('div', class_="text text--size3 property-location__tower-name")
-            micro = location_box1[0].text
-            micro = micro.replace(', ', '-')
-            print(micro)
-            #Macro
-            location_box2 = html_soup2.find_all('div', class_="text text--size3")
-            macro = location_box2[0].text
-            macro = macro.replace('Abu Dhabi, ', '')
-            macro = macro.replace(',', '-')
-            print(macro)
-
-            #Macro
-
-            #print(('\n' + str(location) + ',' + str(description) + ',' + str(title) + ',' + str(price_float) + ',' + str(type) +
-                #              ',' + str(area_str) + ',' + str(bedrooms) +  ',' + str(listed) + ',' + str(lister) + ',' + str(url)))
-            try:
-                resultsfile.WRITE('\n' +str(macro) +',' + str(micro) + ',' + str(description) + ',' + str(price_float) + ',' + str(type) +
-                                  ',' + str(area_str) + ',' + str(bedrooms) + ',' + str(listed) + ',' + str(lister)+ ',' + str(title) + ',' + str(url) + ',' + str(comment))
-            except:
-                print('Skipped Listing %s+1 on page %s'%(a,n))
-                total_skips+=1
-    print('number of skips:')
-    print(total_skips)
+        except:
+            listings.append({'a': a, 'n': n, 'url': None})
+            continue
+        listings.append({'a': a, 'n': n, 'type': type, 'area_str': area_str, 'bedrooms': bedrooms, 'title': title,
+                         'price_float': price_float, 'url': url, 'comment': comment})
+    return listings
 
+def parse_listing_page(html, listing):
+    # Fields from the listing's own page, returned as a results row
+    html_soup2 = BeautifulSoup(html, 'html.parser')
+    #Description
+    desc_container = html_soup2.find_all('div', class_="panel panel--style1 panel--style3")
+    first = desc_container[0]
+    description = first.find_all('h2')[0].text
+    description = description.replace('        ','')
+    description = description.replace(', ','-')
+    description = description.replace('\n','')
+    #Listed
+    listing_box = html_soup2.find_all('div', class_="property-page__legal-list-item property-page__legal-list-item--value")
+    listed = listing_box[1].text
+    #Lister
+    listing_box = html_soup2.find_all('div', class_="text text--size2 property-agent__position")
+    lister = listing_box[0].text
+    #Micro
+    location_box1 = html_soup2.find_all('div', class_="text text--size3 property-location__tower-name")
+    micro = location_box1[0].text
+    micro = micro.replace(', ', '-')
+    #Macro
+    location_box2 = html_soup2.find_all('div', class_="text text--size3")
+    macro = location_box2[0].text
+    macro = macro.replace('Abu Dhabi, ', '')
+    macro = macro.replace(',', '-')
+    return [macro, micro, description, listing['price_float'], listing['type'], listing['area_str'],
+            listing['bedrooms'], listed, lister, listing['title'], listing['url'], listing['comment']]
 
+async def listing_worker(queue, limiter):
+    # Fetch and parse listing pages from the queue until the crawl is finished
+    global total_skips
+    while True:
+        listing = await queue.get()
+        try:
+            html = await fetch(listing['url'], limiter)
+            resultsfile.WRITE_ROW(parse_listing_page(html, listing))
+        except Exception as e:
+            print('Skipped Listing %s+1 on page %s: %s'%(listing['a'],listing['n'],e))
+            total_skips+=1
+        finally:
+            queue.task_done()
 
+async def crawl():
+    # Search pages are read in order, while a pool of workers fetches the listing pages found on them
+    global total_skips
+    limiter = HOSTLIMIT(host_rate, host_burst)
+    # Bounded so the search pages only run a few pages ahead of the workers
+    queue = asyncio.Queue(maxsize=concurrency*4)
+    workers = [asyncio.create_task(listing_worker(queue, limiter)) for i in range(concurrency)]
+    for link in links:
+        if link[0] == '':
+            continue
+        comment = link[1]
+        print(comment)
+        for n in range(total_pages):
+            n += (choosepage-1)
+            n += 1
+            print(n)
+            new_link = link[0].replace('page=1','page=%s'%(n))
+            print(new_link)
+            try:
+                html = await fetch(new_link, limiter)
+            except Exception as e:
+                print('Stopped at page %s: %s'%(n,e))
+                break
+            listings = parse_search_page(html, n, comment)
+            # Past the last page of results
+            if len(listings) == 0:
+                break
+            for listing in listings:
+                if listing['url'] is None:
+                    print('Skipped Listing %s+1 on page %s'%(listing['a'],n))
+                    total_skips+=1
+                    continue
+                await queue.put(listing)
+        # Finish this link's listings before reporting its skips
+        await queue.join()
+        print('number of skips:')
+        print(total_skips)
+    for worker in workers:
+        worker.cancel()
+    resultsfile.CLOSE()
+    session.CLOSE()
 
+asyncio.run(crawl())